@@ -0,0 +1,96 @@
+# coding=utf-8
+# `--auto_batch_size` for main.py: the largest micro-batch that fits on the device is found by running real training
+# steps, and remembered in a JSON file per model, training config and device, so that later runs skip the search.
+
+import json
+import os
+
+import torch
+
+from data_cache import cache_fingerprint
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "quick_sd", "batch_sizes.json")
+
+
+def read_batch_size_cache(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def cached_max_batch_size(path, config, limit):
+    """
+    returns the largest micro-batch found for `config` by an earlier search that covers batch sizes up to `limit`,
+    or None
+    """
+    entry = read_batch_size_cache(path).get(cache_fingerprint(kind="batch_size", **config))
+    if entry is None:
+        return None
+    # A search that stopped at its own limit says nothing about larger batches.
+    if entry["max_batch_size"] < entry["limit"] or limit <= entry["limit"]:
+        return min(entry["max_batch_size"], limit)
+    return None
+
+
+def write_batch_size_cache(path, config, max_batch_size, limit):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Read again right before writing, other runs may have added their own configs in the meantime.
+    cache = read_batch_size_cache(path)
+    cache[cache_fingerprint(kind="batch_size", **config)] = {
+        "max_batch_size": max_batch_size,
+        "limit": limit,
+        "config": config,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def fits_in_memory(step_fn, batch_size):
+    """
+    runs `step_fn(batch_size)` and returns False if it ran out of device memory
+    """
+    try:
+        step_fn(batch_size)
+        torch.cuda.synchronize()
+        return True
+    except torch.cuda.OutOfMemoryError:
+        return False
+    finally:
+        torch.cuda.empty_cache()
+
+
+def find_max_batch_size(fits, limit):
+    """
+    returns the largest batch size up to `limit` for which `fits(batch_size)` is True (0 if not even 1 fits), assuming
+    that every batch size below one that fits also fits. The batch size is doubled until a step fails, then the
+    search bisects between the largest size that fit and the smallest that did not.
+    """
+    low, high = 0, limit + 1
+    while high == limit + 1 and low < limit:
+        size = min(max(2 * low, 1), limit)
+        if fits(size):
+            low = size
+        else:
+            high = size
+    while high - low > 1:
+        size = (low + high) // 2
+        if fits(size):
+            low = size
+        else:
+            high = size
+    return low
+
+
+def split_batch(effective_batch_size, max_batch_size):
+    """
+    returns the (micro-batch size, gradient accumulation steps) with the largest micro-batch up to `max_batch_size`
+    whose accumulation gives exactly `effective_batch_size` samples per optimizer step
+    """
+    for batch_size in range(min(max_batch_size, effective_batch_size), 0, -1):
+        if effective_batch_size % batch_size == 0:
+            return batch_size, effective_batch_size // batch_size
+    raise ValueError(f"No micro-batch size fits, the largest one found was {max_batch_size}.")
@@ -0,0 +1,267 @@
+# coding=utf-8
+# Training throughput benchmark for main.py.
+#
+# Builds tiny, randomly initialized UNet2DConditionModel / AutoencoderKL / CLIPTextModel models locally (nothing is
+# downloaded) and runs the real `training_step` of main.py on synthetic batches for a matrix of training options.
+# Every option set runs in its own process so that its peak RSS is measured in isolation.
+#
+#   python bench.py --device cpu --output bench.json
+#   python bench.py --device cpu --baseline bench.json     # exits with 1 if any option set regressed
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+BENCH_CONFIGS = {
+    "baseline": [],
+    "snr_gamma": ["--snr_gamma=5.0"],
+    "dream_training": ["--dream_training"],
+    "input_perturbation": ["--input_perturbation=0.1"],
+    "gradient_checkpointing": ["--gradient_checkpointing"],
+    "ema": ["--use_ema"],
+    "ema_foreach": ["--use_ema", "--foreach_ema"],
+    "ema_offload": ["--use_ema", "--offload_ema"],
+    "ema_foreach_offload": ["--use_ema", "--foreach_ema", "--offload_ema"],
+    "ema_every_10": ["--use_ema", "--ema_update_every=10"],
+}
+
+# For every metric, whether larger values are better.
+METRICS = {
+    "samples_per_sec": True,
+    "step_ms_p50": False,
+    "step_ms_p90": False,
+    "step_ms_p99": False,
+    "peak_rss_mb": False,
+}
+
+
+def build_tiny_models(seed=0):
+    import torch
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+
+    torch.manual_seed(seed)
+    noise_scheduler = DDPMScheduler(num_train_timesteps=1000)
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            vocab_size=1000,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            max_position_embeddings=77,
+        )
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[8, 16],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4,
+        norm_num_groups=8,
+    )
+    unet = UNet2DConditionModel(
+        block_out_channels=(16, 32),
+        layers_per_block=1,
+        sample_size=16,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        norm_num_groups=8,
+        attention_head_dim=4,
+    )
+    return noise_scheduler, text_encoder, vae, unet
+
+
+def run_config(name, bench_args):
+    """
+    runs the option set `name` in this process and returns its measurements
+    """
+    import torch
+    from accelerate import Accelerator
+    from accelerate.utils import set_seed
+
+    from diffusers import UNet2DConditionModel
+    from diffusers.optimization import get_scheduler
+    from diffusers.training_utils import EMAModel
+    from main import parse_args, training_step
+    from profiling import StepTimer
+    from train_utils import EMAUpdater
+
+    args = parse_args(
+        [
+            "--pretrained_model_name_or_path=tiny",
+            "--train_data_dir=unused",
+            f"--train_batch_size={bench_args.batch_size}",
+            f"--resolution={bench_args.resolution}",
+            "--seed=0",
+        ]
+        + BENCH_CONFIGS[name]
+    )
+    set_seed(args.seed)
+    accelerator = Accelerator(cpu=bench_args.device == "cpu")
+
+    noise_scheduler, text_encoder, vae, unet = build_tiny_models(args.seed)
+    vae.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    unet.train()
+    if args.gradient_checkpointing:
+        unet.enable_gradient_checkpointing()
+    if args.use_ema:
+        ema_unet = EMAModel(
+            unet.parameters(), model_cls=UNet2DConditionModel, model_config=unet.config, foreach=args.foreach_ema
+        )
+
+    optimizer = torch.optim.AdamW(unet.parameters(), lr=args.learning_rate)
+    lr_scheduler = get_scheduler("constant", optimizer=optimizer)
+    unet, optimizer, lr_scheduler = accelerator.prepare(unet, optimizer, lr_scheduler)
+    ema_updater = None
+    if args.use_ema:
+        if args.offload_ema:
+            if torch.cuda.is_available():
+                ema_unet.pin_memory()
+        else:
+            ema_unet.to(accelerator.device)
+        ema_updater = EMAUpdater(ema_unet, args.ema_update_every, asynchronous=args.offload_ema)
+    vae.to(accelerator.device)
+    text_encoder.to(accelerator.device)
+
+    batch = {
+        "pixel_values": torch.rand(args.train_batch_size, 3, args.resolution, args.resolution) * 2 - 1,
+        "input_ids": torch.randint(0, text_encoder.config.vocab_size, (args.train_batch_size, 77)),
+    }
+    batch = {k: v.to(accelerator.device) for k, v in batch.items()}
+    step_timer = StepTimer(accelerator.device)
+
+    step_times = []
+    for i in range(bench_args.warmup + bench_args.iterations):
+        start = time.perf_counter()
+        loss = training_step(
+            args,
+            accelerator,
+            batch,
+            unet,
+            noise_scheduler,
+            optimizer,
+            lr_scheduler,
+            torch.float32,
+            step_timer,
+            vae=vae,
+            text_encoder=text_encoder,
+            latent_scaling_factor=vae.config.scaling_factor,
+            ema_updater=ema_updater,
+        )
+        loss.item()
+        if i >= bench_args.warmup:
+            step_times.append(time.perf_counter() - start)
+
+    step_ms = np.array(step_times) * 1000
+    return {
+        "samples_per_sec": args.train_batch_size * len(step_times) / sum(step_times),
+        "step_ms_p50": float(np.percentile(step_ms, 50)),
+        "step_ms_p90": float(np.percentile(step_ms, 90)),
+        "step_ms_p99": float(np.percentile(step_ms, 99)),
+        # ru_maxrss is in KB on Linux.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new, old = metrics[metric], baseline[name][metric]
+            if higher_is_better and new < old * (1 - tolerance):
+                regressions.append(f"{name}: {metric} {old:.2f} -> {new:.2f}")
+            elif not higher_is_better and new > old * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {old:.2f} -> {new:.2f}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Training throughput benchmark for main.py with tiny models.")
+    parser.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--resolution", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=3, help="Number of untimed steps before measuring.")
+    parser.add_argument("--iterations", type=int, default=20, help="Number of timed steps per option set.")
+    parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=list(BENCH_CONFIGS),
+        choices=list(BENCH_CONFIGS),
+        help="The option sets to benchmark.",
+    )
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare the results to this JSON file.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative change of a metric against the baseline that is reported as a regression.",
+    )
+    parser.add_argument("--run_config", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.run_config is not None:
+        print(json.dumps(run_config(args.run_config, args)))
+        return
+
+    forwarded = [
+        f"--device={args.device}",
+        f"--batch_size={args.batch_size}",
+        f"--resolution={args.resolution}",
+        f"--warmup={args.warmup}",
+        f"--iterations={args.iterations}",
+    ]
+    results = {}
+    print(f"{'config':<24}{'samples/s':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'peak RSS MB':>14}")
+    for name in args.configs:
+        process = subprocess.run(
+            [sys.executable, __file__, f"--run_config={name}"] + forwarded, capture_output=True, text=True
+        )
+        if process.returncode != 0:
+            print(process.stderr, file=sys.stderr)
+            raise RuntimeError(f"Benchmark config `{name}` failed.")
+        metrics = json.loads(process.stdout.strip().splitlines()[-1])
+        results[name] = metrics
+        print(
+            f"{name:<24}{metrics['samples_per_sec']:>12.2f}{metrics['step_ms_p50']:>10.1f}"
+            f"{metrics['step_ms_p90']:>10.1f}{metrics['step_ms_p99']:>10.1f}{metrics['peak_rss_mb']:>14.1f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
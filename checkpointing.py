@@ -0,0 +1,313 @@
+# coding=utf-8
+# Training checkpoints written in the background.
+#
+# The layout of a `checkpoint-N` directory is the one `accelerator.save_state` produces with the save hook of
+# main.py, so `accelerator.load_state` (and `--resume_from_checkpoint`) can read it back:
+#
+#   checkpoint-N/unet/                  config.json + diffusion_pytorch_model(-0000k-of-0000n).safetensors
+#   checkpoint-N/unet_ema/              same, with the EMA settings in config.json (only with `--use_ema`)
+#   checkpoint-N/optimizer.bin          torch.save of the optimizer state dict
+#   checkpoint-N/scheduler.bin          torch.save of the lr scheduler state dict
+#   checkpoint-N/scaler.pt              torch.save of the fp16 grad scaler state dict, if any
+#   checkpoint-N/random_states_K.pkl    RNG states of process K
+#   checkpoint-N/sampler_state.json     shuffle seed, epoch and number of batches of that epoch already trained on
+
+import copy
+import json
+import math
+import os
+import random
+import shutil
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+WEIGHTS_NAME = "diffusion_pytorch_model.safetensors"
+WEIGHTS_INDEX_NAME = "diffusion_pytorch_model.safetensors.index.json"
+SAMPLER_STATE_NAME = "sampler_state.json"
+
+# Exit code of a run that stopped after an emergency checkpoint (EX_TEMPFAIL): relaunch it with
+# `--resume_from_checkpoint latest`. running.py keeps its own copy of this value.
+PREEMPTED_EXIT_CODE = 75
+
+
+def list_checkpoints(output_dir):
+    """
+    returns the `checkpoint-N` directory names in `output_dir`, oldest first
+    """
+    if not os.path.isdir(output_dir):
+        return []
+    dirs = [d for d in os.listdir(output_dir) if d.startswith("checkpoint-") and d.split("-")[1].isdigit()]
+    return sorted(dirs, key=lambda x: int(x.split("-")[1]))
+
+
+def rotate_checkpoints(output_dir, total_limit):
+    """
+    removes the oldest checkpoints so that at most `total_limit` remain
+    """
+    if total_limit is None:
+        return
+    checkpoints = list_checkpoints(output_dir)
+    for name in checkpoints[: max(len(checkpoints) - total_limit, 0)]:
+        shutil.rmtree(os.path.join(output_dir, name))
+
+
+def read_sampler_state(checkpoint_dir):
+    """
+    returns the sampler state saved with a checkpoint, or None for checkpoints written without one
+    """
+    path = os.path.join(checkpoint_dir, SAMPLER_STATE_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def rng_states(step):
+    # Same content as the `random_states_K.pkl` written by `accelerator.save_state`.
+    states = {
+        "step": step,
+        "random_state": random.getstate(),
+        "numpy_random_seed": np.random.get_state(),
+        "torch_manual_seed": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def write_safetensors(state_dict, directory, max_shard_bytes):
+    """
+    writes `state_dict` in the (possibly sharded) safetensors layout that `ModelMixin.from_pretrained` reads
+    """
+    shards = [{}]
+    shard_bytes = 0
+    for name, tensor in state_dict.items():
+        size = tensor.numel() * tensor.element_size()
+        if shards[-1] and shard_bytes + size > max_shard_bytes:
+            shards.append({})
+            shard_bytes = 0
+        shards[-1][name] = tensor
+        shard_bytes += size
+
+    if len(shards) == 1:
+        save_file(shards[0], os.path.join(directory, WEIGHTS_NAME), metadata={"format": "pt"})
+        return
+
+    weight_map = {}
+    for i, shard in enumerate(shards):
+        filename = WEIGHTS_NAME.replace(".safetensors", f"-{i + 1:05d}-of-{len(shards):05d}.safetensors")
+        save_file(shard, os.path.join(directory, filename), metadata={"format": "pt"})
+        weight_map.update({name: filename for name in shard})
+    index = {
+        "metadata": {"total_size": sum(t.numel() * t.element_size() for t in state_dict.values())},
+        "weight_map": weight_map,
+    }
+    with open(os.path.join(directory, WEIGHTS_INDEX_NAME), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def load_safetensors_into(targets, directory):
+    """
+    copies the (possibly sharded) safetensors weights in `directory` into the existing tensors of `targets`, a
+    name -> tensor dict, in place and on whatever device they live. The files are memory-mapped and read one tensor
+    at a time, so no second copy of the model is ever materialized.
+    """
+    index_path = os.path.join(directory, WEIGHTS_INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            filenames = sorted(set(json.load(f)["weight_map"].values()))
+    else:
+        filenames = [WEIGHTS_NAME]
+
+    missing = set(targets)
+    with torch.no_grad():
+        for filename in filenames:
+            with safe_open(os.path.join(directory, filename), framework="pt", device="cpu") as f:
+                for name in f.keys():
+                    if name not in targets:
+                        raise ValueError(f"Unexpected tensor `{name}` in {os.path.join(directory, filename)}.")
+                    targets[name].copy_(f.get_tensor(name))
+                    missing.discard(name)
+    if missing:
+        raise ValueError(f"Missing tensors in {directory}: {', '.join(sorted(missing))}.")
+
+
+def has_safetensors(directory):
+    return os.path.exists(os.path.join(directory, WEIGHTS_NAME)) or os.path.exists(
+        os.path.join(directory, WEIGHTS_INDEX_NAME)
+    )
+
+
+class AsyncCheckpointWriter:
+    """
+    Saves training checkpoints without waiting for the disk. `save` copies the UNet, EMA, optimizer and scheduler
+    states into reusable pinned host buffers, which is the only time the training loop is stalled, and then writes
+    the files, renames the directory into place and rotates old checkpoints on a background thread. A checkpoint
+    only appears as `checkpoint-N` once it is complete.
+
+    Every process has to call `save` (each one writes its own RNG states); the model, optimizer and scheduler states
+    are only written by the main process.
+    """
+
+    def __init__(self, accelerator, output_dir, total_limit=None, max_shard_size_mb=5 * 1024):
+        self.accelerator = accelerator
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self.max_shard_bytes = int(max_shard_size_mb * 2**20)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+        self._pending = None
+        self._host_buffers = {}
+
+    def _to_host(self, key, tensor):
+        tensor = tensor.detach()
+        buffer = self._host_buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+            self._host_buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=True)
+        return buffer
+
+    def _state_to_host(self, prefix, state):
+        if isinstance(state, torch.Tensor):
+            return self._to_host(prefix, state)
+        elif isinstance(state, dict):
+            return {k: self._state_to_host(f"{prefix}.{k}", v) for k, v in state.items()}
+        elif isinstance(state, (list, tuple)):
+            return type(state)(self._state_to_host(f"{prefix}.{i}", v) for i, v in enumerate(state))
+        return copy.deepcopy(state)
+
+    def wait(self):
+        """
+        blocks until the checkpoint being written (if any) is complete, and re-raises its error if it failed
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def save(self, step, unet, optimizer, lr_scheduler, ema_unet=None, sampler_state=None):
+        # The host buffers are reused, so the previous checkpoint has to be on disk before they are overwritten.
+        self.wait()
+        name = f"checkpoint-{step}"
+        tmp_dir = os.path.join(self.output_dir, f"tmp-{name}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        torch.save(
+            rng_states(self.accelerator.step),
+            os.path.join(tmp_dir, f"random_states_{self.accelerator.process_index}.pkl"),
+        )
+        self.accelerator.wait_for_everyone()
+        if not self.accelerator.is_main_process:
+            return
+
+        unet = self.accelerator.unwrap_model(unet)
+        unet_config = json.loads(unet.to_json_string())
+        unet_state = {k: self._to_host(f"unet.{k}", v) for k, v in unet.state_dict().items()}
+        ema_config = ema_state = None
+        if ema_unet is not None:
+            ema_config = dict(unet_config)
+            ema_settings = ema_unet.state_dict()
+            ema_settings.pop("shadow_params")
+            ema_config.update(ema_settings)
+            ema_state = {
+                name: self._to_host(f"ema.{name}", param)
+                for (name, _), param in zip(unet.named_parameters(), ema_unet.shadow_params)
+            }
+        optimizer_state = self._state_to_host("optimizer", optimizer.state_dict())
+        scheduler_state = copy.deepcopy(lr_scheduler.state_dict())
+        scaler_state = self.accelerator.scaler.state_dict() if self.accelerator.scaler is not None else None
+        if torch.cuda.is_available():
+            # The device-to-host copies above are asynchronous.
+            torch.cuda.synchronize()
+
+        self._pending = self._executor.submit(
+            self._write,
+            tmp_dir,
+            os.path.join(self.output_dir, name),
+            unet_config,
+            unet_state,
+            ema_config,
+            ema_state,
+            optimizer_state,
+            scheduler_state,
+            scaler_state,
+            sampler_state,
+        )
+
+    def _write(
+        self,
+        tmp_dir,
+        final_dir,
+        unet_config,
+        unet_state,
+        ema_config,
+        ema_state,
+        optimizer_state,
+        scheduler_state,
+        scaler_state,
+        sampler_state,
+    ):
+        for subfolder, config, state in (("unet", unet_config, unet_state), ("unet_ema", ema_config, ema_state)):
+            if state is None:
+                continue
+            os.makedirs(os.path.join(tmp_dir, subfolder), exist_ok=True)
+            with open(os.path.join(tmp_dir, subfolder, "config.json"), "w") as f:
+                json.dump(config, f, indent=2, sort_keys=True)
+            write_safetensors(state, os.path.join(tmp_dir, subfolder), self.max_shard_bytes)
+        torch.save(optimizer_state, os.path.join(tmp_dir, "optimizer.bin"))
+        torch.save(scheduler_state, os.path.join(tmp_dir, "scheduler.bin"))
+        if scaler_state is not None:
+            torch.save(scaler_state, os.path.join(tmp_dir, "scaler.pt"))
+        if sampler_state is not None:
+            with open(os.path.join(tmp_dir, SAMPLER_STATE_NAME), "w") as f:
+                json.dump(sampler_state, f, indent=2)
+
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.replace(tmp_dir, final_dir)
+        rotate_checkpoints(self.output_dir, self.total_limit)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
+class PreemptionHandler:
+    """
+    Turns SIGTERM / SIGUSR1 into a request to stop: the signal handler only sets `requested`, so the training loop
+    finishes its current optimizer step, writes an emergency checkpoint and exits with `PREEMPTED_EXIT_CODE`.
+
+    If the run has not exited `grace_period` seconds after the signal (e.g. a step or the checkpoint takes too long),
+    the process exits immediately with the same code; the last complete checkpoint is still there to resume from.
+    """
+
+    def __init__(self, grace_period=60, signals=(signal.SIGTERM, signal.SIGUSR1)):
+        self.grace_period = grace_period
+        self.signals = signals
+        self.requested = False
+        self.signal_name = None
+
+    def install(self):
+        for signum in self.signals:
+            signal.signal(signum, self._handle)
+        if self.grace_period > 0:
+            signal.signal(signal.SIGALRM, self._expire)
+
+    def _handle(self, signum, frame):
+        if self.requested:
+            return
+        self.requested = True
+        self.signal_name = signal.Signals(signum).name
+        if self.grace_period > 0:
+            signal.alarm(math.ceil(self.grace_period))
+
+    def _expire(self, signum, frame):
+        print(
+            f"No emergency checkpoint within the {self.grace_period}s grace period after {self.signal_name}, exiting.",
+            flush=True,
+        )
+        os._exit(PREEMPTED_EXIT_CODE)
@@ -0,0 +1,476 @@
+# coding=utf-8
+# Precomputed, memory-mapped caches for the fixed part of the training data.
+#
+# Every cache lives in `<root>/<fingerprint>/`, where the fingerprint hashes all settings that change its
+# content. A cache is complete once its `index.json` exists; it is built in a temporary directory and renamed into
+# place so that an interrupted build is never picked up by a later run.
+
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+
+import datasets
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from data_utils import assign_buckets
+
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_SHARD_SIZE = 4096
+
+
+def cache_fingerprint(**settings):
+    payload = json.dumps(dict(settings, version=CACHE_FORMAT_VERSION), sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def read_cache_index(cache_dir):
+    """
+    returns the index of a complete cache in `cache_dir`, or None if there is no complete cache there
+    """
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+def caption_variants(caption, caption_column):
+    if isinstance(caption, str):
+        return [caption]
+    elif isinstance(caption, (list, np.ndarray)):
+        return list(caption)
+    raise ValueError(f"Caption column `{caption_column}` should contain either strings or lists of strings.")
+
+
+def flatten_captions(captions, caption_column):
+    """
+    returns all caption variants as one flat list, and the offsets of the variants of every sample into it
+    """
+    variants = [caption_variants(caption, caption_column) for caption in captions]
+    offsets = np.zeros(len(variants) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in variants])
+    return [variant for v in variants for variant in v], offsets
+
+
+class ShardWriter:
+    """Writes `num_rows` fixed-shape rows into a sequence of `.npy` memmap shards."""
+
+    def __init__(self, directory, prefix, num_rows, row_shape, dtype, shard_size=DEFAULT_SHARD_SIZE):
+        self.directory = directory
+        self.prefix = prefix
+        self.num_rows = num_rows
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self._shards = {}
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            rows = min(self.shard_size, self.num_rows - shard_id * self.shard_size)
+            path = os.path.join(self.directory, f"{self.prefix}-{shard_id:05d}.npy")
+            self._shards[shard_id] = np.lib.format.open_memmap(
+                path, mode="w+", dtype=self.dtype, shape=(rows,) + self.row_shape
+            )
+        return self._shards[shard_id]
+
+    def write(self, start, values):
+        values = np.asarray(values, dtype=self.dtype)
+        offset = 0
+        while offset < len(values):
+            shard_id, row = divmod(start + offset, self.shard_size)
+            shard = self._shard(shard_id)
+            count = min(len(values) - offset, len(shard) - row)
+            shard[row : row + count] = values[offset : offset + count]
+            offset += count
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.flush()
+        self._shards.clear()
+
+    def describe(self):
+        return {
+            "num_rows": self.num_rows,
+            "row_shape": list(self.row_shape),
+            "dtype": self.dtype.str,
+            "shard_size": self.shard_size,
+        }
+
+
+class ShardReader:
+    """Read-only, zero-copy view over the shards written by `ShardWriter`."""
+
+    def __init__(self, directory, prefix, description):
+        self.num_rows = description["num_rows"]
+        self.row_shape = tuple(description["row_shape"])
+        self.shard_size = description["shard_size"]
+        num_shards = math.ceil(self.num_rows / self.shard_size)
+        self.shards = [
+            np.load(os.path.join(directory, f"{prefix}-{shard_id:05d}.npy"), mmap_mode="r")
+            for shard_id in range(num_shards)
+        ]
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx):
+        shard_id, row = divmod(idx, self.shard_size)
+        return self.shards[shard_id][row]
+
+
+def begin_cache_build(cache_dir):
+    tmp_dir = cache_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def finish_cache_build(tmp_dir, cache_dir, index):
+    with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+
+
+# Latent + text-embedding cache
+
+
+def latent_cache_transforms(resolution, center_crop):
+    # Random crops and flips are frozen into the cache; flips are handled by caching a mirrored view as well.
+    return transforms.Compose(
+        [
+            transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR),
+            transforms.CenterCrop(resolution) if center_crop else transforms.RandomCrop(resolution),
+            transforms.ToTensor(),
+            transforms.Normalize([0.5], [0.5]),
+        ]
+    )
+
+
+@torch.no_grad()
+def build_latent_cache(
+    cache_dir,
+    dataset,
+    image_column,
+    caption_column,
+    tokenizer,
+    vae,
+    text_encoder,
+    resolution,
+    center_crop=False,
+    random_flip=False,
+    batch_size=16,
+    storage_dtype=np.float16,
+    shard_size=DEFAULT_SHARD_SIZE,
+    progress_bar=None,
+):
+    """
+    Encodes every image of `dataset` with `vae` and every caption variant with `text_encoder` once, and writes the
+    latent distribution moments (mean and logvar) and the encoder hidden states to memory-mapped shards.
+    """
+    device = vae.device
+    vae_dtype = vae.dtype
+    tmp_dir = begin_cache_build(cache_dir)
+    image_transforms = latent_cache_transforms(resolution, center_crop)
+    num_views = 2 if random_flip else 1
+
+    # Captions are cheap to read without decoding images, so lay out the caption variants first.
+    flat_captions, caption_offsets = flatten_captions(dataset[caption_column], caption_column)
+    np.save(os.path.join(tmp_dir, "caption_offsets.npy"), caption_offsets)
+
+    hidden_writer = None
+    for start in range(0, len(flat_captions), batch_size):
+        input_ids = tokenizer(
+            flat_captions[start : start + batch_size],
+            max_length=tokenizer.model_max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt",
+        ).input_ids
+        hidden_states = text_encoder(input_ids.to(text_encoder.device), return_dict=False)[0]
+        hidden_states = hidden_states.float().cpu().numpy()
+        if hidden_writer is None:
+            hidden_writer = ShardWriter(
+                tmp_dir, "hidden_states", len(flat_captions), hidden_states.shape[1:], storage_dtype, shard_size
+            )
+        hidden_writer.write(start, hidden_states)
+    hidden_writer.close()
+
+    latent_writer = None
+    for start in range(0, len(dataset), batch_size):
+        images = dataset[start : start + batch_size][image_column]
+        pixel_values = torch.stack([image_transforms(image.convert("RGB")) for image in images])
+        if random_flip:
+            pixel_values = torch.cat([pixel_values, torch.flip(pixel_values, dims=[3])])
+        latent_dist = vae.encode(pixel_values.to(device, dtype=vae_dtype)).latent_dist
+        moments = torch.cat([latent_dist.mean, latent_dist.logvar], dim=1).float().cpu()
+        # [views * batch, 2C, h, w] -> [batch, views, 2C, h, w]
+        moments = moments.view(num_views, len(images), *moments.shape[1:]).transpose(0, 1).numpy()
+        if latent_writer is None:
+            latent_writer = ShardWriter(tmp_dir, "latents", len(dataset), moments.shape[1:], storage_dtype, shard_size)
+        latent_writer.write(start, moments)
+        if progress_bar is not None:
+            progress_bar.update(len(images))
+    latent_writer.close()
+
+    index = {
+        "kind": "latents",
+        "num_samples": len(dataset),
+        "num_views": num_views,
+        "scaling_factor": vae.config.scaling_factor,
+        "latents": latent_writer.describe(),
+        "hidden_states": hidden_writer.describe(),
+    }
+    finish_cache_build(tmp_dir, cache_dir, index)
+    return index
+
+
+def sample_cached_latents(moments):
+    # Same as `DiagonalGaussianDistribution(moments).sample()` without materializing the distribution object.
+    mean, logvar = torch.chunk(moments, 2, dim=1)
+    logvar = torch.clamp(logvar, -30.0, 20.0)
+    return mean + torch.exp(0.5 * logvar) * torch.randn_like(mean)
+
+
+class LatentCacheDataset(torch.utils.data.Dataset):
+    def __init__(self, cache_dir):
+        index = read_cache_index(cache_dir)
+        if index is None or index.get("kind") != "latents":
+            raise ValueError(f"No complete latent cache found in {cache_dir}.")
+        self.num_samples = index["num_samples"]
+        self.num_views = index["num_views"]
+        self.scaling_factor = index["scaling_factor"]
+        self.latents = ShardReader(cache_dir, "latents", index["latents"])
+        self.hidden_states = ShardReader(cache_dir, "hidden_states", index["hidden_states"])
+        self.caption_offsets = np.load(os.path.join(cache_dir, "caption_offsets.npy"))
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        view = random.randrange(self.num_views)
+        # take a random caption if there are multiple
+        caption = random.randrange(self.caption_offsets[idx], self.caption_offsets[idx + 1])
+        return {
+            "latent_moments": torch.from_numpy(np.array(self.latents[idx][view])),
+            "encoder_hidden_states": torch.from_numpy(np.array(self.hidden_states[caption])),
+        }
+
+
+# Pre-decoded uint8 image cache
+
+
+@torch.no_grad()
+def build_image_cache(cache_dir, dataset, image_column, resolution, center_crop=False, progress_bar=None):
+    """
+    Decodes every image of `dataset` once, resizes its shorter side to `resolution` (and center crops it if
+    `center_crop`), and appends the HWC uint8 pixels to one contiguous file with an (offset, height, width) index.
+    """
+    tmp_dir = begin_cache_build(cache_dir)
+    resize = transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR)
+    crop = transforms.CenterCrop(resolution) if center_crop else None
+
+    offsets = np.zeros((len(dataset), 3), dtype=np.int64)
+    offset = 0
+    with open(os.path.join(tmp_dir, "pixels.u8"), "wb") as f:
+        for start in range(0, len(dataset), 64):
+            images = dataset[start : start + 64][image_column]
+            for i, image in enumerate(images):
+                image = resize(image.convert("RGB"))
+                if crop is not None:
+                    image = crop(image)
+                pixels = np.asarray(image, dtype=np.uint8)
+                f.write(pixels.tobytes())
+                offsets[start + i] = (offset, pixels.shape[0], pixels.shape[1])
+                offset += pixels.size
+            if progress_bar is not None:
+                progress_bar.update(len(images))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+
+    index = {
+        "kind": "images",
+        "num_samples": len(dataset),
+        "resolution": resolution,
+        "center_crop": center_crop,
+        "num_bytes": offset,
+    }
+    finish_cache_build(tmp_dir, cache_dir, index)
+    return index
+
+
+class ImageCacheDataset(torch.utils.data.Dataset):
+    """
+    Serves crops of the images written by `build_image_cache` as zero-copy slices of the memory-mapped pixel file.
+    With `normalize=False` the pixel values are returned as uint8 and left for `augment_on_device` to normalize.
+    """
+
+    def __init__(self, cache_dir, random_flip=False, normalize=True):
+        index = read_cache_index(cache_dir)
+        if index is None or index.get("kind") != "images":
+            raise ValueError(f"No complete image cache found in {cache_dir}.")
+        self.resolution = index["resolution"]
+        self.random_flip = random_flip
+        self.normalize = normalize
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy"))
+        self.pixels = np.memmap(os.path.join(cache_dir, "pixels.u8"), dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def crop(self, idx):
+        """
+        returns a random `resolution` x `resolution` HWC uint8 crop of image `idx`, possibly flipped horizontally
+        """
+        offset, height, width = (int(v) for v in self.offsets[idx])
+        image = self.pixels[offset : offset + height * width * 3].reshape(height, width, 3)
+        top = random.randint(0, height - self.resolution)
+        left = random.randint(0, width - self.resolution)
+        image = image[top : top + self.resolution, left : left + self.resolution]
+        if self.random_flip and random.random() < 0.5:
+            image = image[:, ::-1]
+        return image
+
+    def __getitem__(self, idx):
+        pixel_values = torch.from_numpy(np.array(self.crop(idx))).permute(2, 0, 1)
+        if self.normalize:
+            # Same as `ToTensor()` followed by `Normalize([0.5], [0.5])`.
+            pixel_values = pixel_values.float().div_(127.5).sub_(1.0)
+        return {"pixel_values": pixel_values}
+
+
+# Aspect-ratio bucket assignment
+
+
+def build_bucket_cache(cache_dir, dataset, image_column, buckets, progress_bar=None):
+    """
+    Assigns every image of `dataset` to one of `buckets` from its size. Only the image headers are read.
+    """
+    tmp_dir = begin_cache_build(cache_dir)
+    undecoded = dataset.cast_column(image_column, datasets.Image(decode=False))
+    sizes = []
+    for start in range(0, len(undecoded), 1024):
+        for image in undecoded[start : start + 1024][image_column]:
+            with Image.open(io.BytesIO(image["bytes"]) if image["bytes"] else image["path"]) as f:
+                sizes.append(f.size)
+        if progress_bar is not None:
+            progress_bar.update(min(1024, len(undecoded) - start))
+    np.save(os.path.join(tmp_dir, "bucket_ids.npy"), assign_buckets(sizes, buckets))
+
+    index = {"kind": "buckets", "num_samples": len(dataset), "buckets": [list(bucket) for bucket in buckets]}
+    finish_cache_build(tmp_dir, cache_dir, index)
+    return index
+
+
+def read_bucket_cache(cache_dir):
+    """
+    returns the buckets as (height, width) tuples and the bucket id of every sample
+    """
+    index = read_cache_index(cache_dir)
+    if index is None or index.get("kind") != "buckets":
+        raise ValueError(f"No complete bucket assignment found in {cache_dir}.")
+    buckets = [tuple(bucket) for bucket in index["buckets"]]
+    return buckets, np.load(os.path.join(cache_dir, "bucket_ids.npy"))
+
+
+# Pre-tokenized captions
+
+
+def build_caption_cache(cache_dir, captions, caption_column, tokenizer, batch_size=1024):
+    """
+    Tokenizes every caption variant once and stores the unpadded token ids back to back as int32, with offsets of
+    every variant into the tokens and of the variants of every sample.
+    """
+    tmp_dir = begin_cache_build(cache_dir)
+    flat_captions, caption_offsets = flatten_captions(captions, caption_column)
+
+    token_ids = []
+    for start in range(0, len(flat_captions), batch_size):
+        token_ids += tokenizer(
+            flat_captions[start : start + batch_size], max_length=tokenizer.model_max_length, truncation=True
+        ).input_ids
+    token_offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+    token_offsets[1:] = np.cumsum([len(ids) for ids in token_ids])
+    tokens = np.fromiter((i for ids in token_ids for i in ids), dtype=np.int32, count=int(token_offsets[-1]))
+    np.save(os.path.join(tmp_dir, "tokens.npy"), tokens)
+    np.save(os.path.join(tmp_dir, "token_offsets.npy"), token_offsets)
+    np.save(os.path.join(tmp_dir, "caption_offsets.npy"), caption_offsets)
+
+    index = {
+        "kind": "captions",
+        "num_samples": len(caption_offsets) - 1,
+        "num_variants": len(flat_captions),
+        "max_length": tokenizer.model_max_length,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    finish_cache_build(tmp_dir, cache_dir, index)
+    return index
+
+
+class CaptionTokenIndex:
+    """
+    Looks up the padded token ids of one caption variant per sample from the arrays written by `build_caption_cache`.
+    Among multiple variants the choice is a function of `seed`, the epoch and the sample index only, so it is
+    reproducible and does not depend on the number of dataloader workers. The epoch lives in shared memory so that
+    `set_epoch` also reaches persistent workers.
+    """
+
+    def __init__(self, cache_dir, seed=0):
+        index = read_cache_index(cache_dir)
+        if index is None or index.get("kind") != "captions":
+            raise ValueError(f"No complete caption index found in {cache_dir}.")
+        self.max_length = index["max_length"]
+        self.pad_token_id = index["pad_token_id"]
+        self.tokens = np.load(os.path.join(cache_dir, "tokens.npy"), mmap_mode="r")
+        self.token_offsets = np.load(os.path.join(cache_dir, "token_offsets.npy"), mmap_mode="r")
+        self.caption_offsets = np.load(os.path.join(cache_dir, "caption_offsets.npy"), mmap_mode="r")
+        self.seed = seed
+        self._epoch = multiprocessing.Value("q", 0, lock=False)
+
+    def __len__(self):
+        return len(self.caption_offsets) - 1
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def input_ids(self, idx):
+        start, end = int(self.caption_offsets[idx]), int(self.caption_offsets[idx + 1])
+        variant = start
+        if end - start > 1:
+            # take a random caption if there are multiple
+            variant += int(np.random.default_rng((self.seed, self._epoch.value, int(idx))).integers(end - start))
+        tokens = self.tokens[self.token_offsets[variant] : self.token_offsets[variant + 1]]
+        input_ids = np.full(self.max_length, self.pad_token_id, dtype=np.int64)
+        input_ids[: len(tokens)] = tokens
+        return torch.from_numpy(input_ids)
+
+
+class CaptionIndexedDataset(torch.utils.data.Dataset):
+    """Adds the pre-tokenized `input_ids` of sample `idx` to every example of `dataset`."""
+
+    def __init__(self, dataset, caption_index):
+        if len(dataset) != len(caption_index):
+            raise ValueError("The caption index does not match the dataset.")
+        self.dataset = dataset
+        self.caption_index = caption_index
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def set_epoch(self, epoch):
+        self.caption_index.set_epoch(epoch)
+
+    def __getitem__(self, idx):
+        example = self.dataset[idx]
+        example["input_ids"] = self.caption_index.input_ids(idx)
+        return example
@@ -0,0 +1,240 @@
+# coding=utf-8
+# Input pipeline helpers for main.py that are independent of where the samples come from.
+
+import math
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from torchvision.transforms import functional as TF
+
+
+def augment_on_device(pixel_values, random_flip=False, dtype=torch.float32):
+    """
+    Batched counterpart of `RandomHorizontalFlip()`, `ToTensor()` and `Normalize([0.5], [0.5])` for a uint8 NCHW
+    batch that has already been moved to the training device.
+    """
+    if random_flip:
+        flip = torch.rand(pixel_values.shape[0], device=pixel_values.device) < 0.5
+        pixel_values = torch.where(flip[:, None, None, None], pixel_values.flip(-1), pixel_values)
+    return pixel_values.float().div_(127.5).sub_(1.0).to(dtype, memory_format=torch.contiguous_format)
+
+
+def _map_tensors(fn, data):
+    if isinstance(data, torch.Tensor):
+        return fn(data)
+    elif isinstance(data, dict):
+        return {k: _map_tensors(fn, v) for k, v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)(_map_tensors(fn, v) for v in data)
+    return data
+
+
+_END_OF_DATA = object()
+
+
+class BatchPrefetcher:
+    """
+    Iterates `dataloader` on a background thread and keeps up to `num_batches` batches in flight ahead of the
+    training loop. On CUDA the batches are pinned and copied to `device` on a side stream, so the host-to-device copy
+    overlaps with the current step. `wait_time` is how long the last batch kept the training loop waiting.
+
+    The dataloader should not place batches on the device itself (`prepare_data_loader(..., device_placement=False)`).
+    The background thread only starts at the first `next()`, after the previous epoch has been fully consumed, so the
+    RNG synchronization that accelerate runs when an epoch starts never overlaps with a collective of the training
+    loop.
+
+    An accelerate dataloader flags its last batch in the `GradientState`, which `accelerator.accumulate` reads to
+    step at the end of an epoch. Read on the background thread, that flag would be set batches too early, so with
+    `gradient_state` the prefetcher registers itself as the active dataloader and flags the last batch when the
+    training loop receives it.
+    """
+
+    def __init__(self, dataloader, device, num_batches=2, gradient_state=None):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+        self.gradient_state = gradient_state
+        self.wait_time = 0.0
+        self.total_wait_time = 0.0
+        # Read by `gradient_state` while the prefetcher is its active dataloader.
+        self.end_of_dataloader = False
+        self.remainder = -1
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.dataloader, "set_epoch"):
+            self.dataloader.set_epoch(epoch)
+
+    def _copy(self, tensor):
+        if self.device.type == "cuda" and not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def _put(self, batches, stop, item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stop, registered):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for batch in self.dataloader:
+                # Set by accelerate's dataloader before it yields its last batch.
+                is_last = getattr(self.dataloader, "end_of_dataloader", False)
+                event = None
+                with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                    batch = _map_tensors(self._copy, batch)
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                if not self._put(batches, stop, (batch, event, is_last)):
+                    return
+                if is_last:
+                    # The dataloader unregisters itself from the gradient state on the next step of the loop, which
+                    # must not race with the training loop registering the prefetcher.
+                    while not registered.wait(timeout=0.1):
+                        if stop.is_set():
+                            return
+        except Exception as e:
+            self._put(batches, stop, e)
+            return
+        self._put(batches, stop, _END_OF_DATA)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        registered = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop, registered), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time = time.perf_counter() - start
+                self.total_wait_time += self.wait_time
+                if item is _END_OF_DATA:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch, event, self.end_of_dataloader = item
+                if self.gradient_state is not None and not registered.is_set():
+                    # After the dataloader registered itself on the background thread, so the prefetcher comes last
+                    # and is the active one.
+                    self.remainder = getattr(self.dataloader, "remainder", -1)
+                    self.gradient_state._add_dataloader(self)
+                registered.set()
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # The tensors were allocated on the side stream but are consumed on the current one.
+                    _map_tensors(lambda t: t.record_stream(current_stream), batch)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            self.end_of_dataloader = False
+            if self.gradient_state is not None and registered.is_set():
+                self.gradient_state._remove_dataloader(self)
+
+
+# Aspect-ratio bucketing
+
+
+def make_buckets(resolution, step=64, max_aspect_ratio=2.0):
+    """
+    returns the (height, width) buckets whose sides are multiples of `step` and whose area is as close as possible to
+    (but not more than) `resolution` x `resolution`
+    """
+    area = resolution * resolution
+    buckets = set()
+    for width in range(step, int(resolution * math.sqrt(max_aspect_ratio)) + 1, step):
+        height = area // width // step * step
+        if height < step or max(width / height, height / width) > max_aspect_ratio:
+            continue
+        buckets.add((height, width))
+        buckets.add((width, height))
+    return sorted(buckets)
+
+
+def assign_buckets(sizes, buckets):
+    """
+    returns, for every (width, height) in `sizes`, the index of the bucket with the closest aspect ratio
+    """
+    bucket_ratios = np.log([height / width for height, width in buckets])
+    ratios = np.log([height / width for width, height in sizes])
+    return np.abs(ratios[:, None] - bucket_ratios[None, :]).argmin(axis=1).astype(np.int32)
+
+
+def resize_to_cover(image, size):
+    # Smallest resize that keeps the aspect ratio and covers the (height, width) bucket, before cropping to it.
+    height, width = size
+    scale = max(height / image.height, width / image.width)
+    return TF.resize(
+        image,
+        [max(height, math.ceil(image.height * scale)), max(width, math.ceil(image.width * scale))],
+        interpolation=TF.InterpolationMode.BILINEAR,
+    )
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields batches of indices that all belong to the same bucket, so that every batch has a single image shape. The
+    order is shuffled within each bucket and across batches, and is a function of `seed` and the epoch set with
+    `set_epoch`. With `drop_last`, incomplete batches are dropped. With a single bucket this is a plain shuffling
+    batch sampler.
+
+    Since the order only depends on `seed` and the epoch, a resumed run can jump to any batch of an epoch with
+    `skip_batches` without loading the batches before it.
+    """
+
+    def __init__(self, bucket_ids, batch_size, seed=0, drop_last=True):
+        self.bucket_ids = np.asarray(bucket_ids)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip_batches(self, num_batches):
+        """
+        skips the first `num_batches` batches of the next iteration only
+        """
+        self.start_batch = num_batches
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+
+    def __len__(self):
+        counts = np.bincount(self.bucket_ids)
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(np.ceil(counts[counts > 0] / self.batch_size).sum())
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        rng = np.random.default_rng((self.seed, self.epoch))
+        batches = []
+        for bucket in np.unique(self.bucket_ids):
+            indices = rng.permutation(np.flatnonzero(self.bucket_ids == bucket))
+            end = len(indices) - self.batch_size + 1 if self.drop_last else len(indices)
+            for start in range(0, end, self.batch_size):
+                batches.append(indices[start : start + self.batch_size].tolist())
+        for i in rng.permutation(len(batches))[start_batch:]:
+            yield batches[i]
@@ -0,0 +1,80 @@
+# coding=utf-8
+# Deferred imports for main.py, so that `--help` and argument errors do not wait for torch, diffusers & co.
+
+import importlib
+import time
+from functools import partial
+
+
+# Every lazy object, in the order they were declared, and the time its first use spent importing.
+_REGISTRY = []
+_IMPORT_TIMES = {}
+
+
+class LazyObject:
+    """
+    Stands in for the object returned by `factory` (a module, an attribute of a module, ...) and creates it on first
+    attribute access or call.
+    """
+
+    def __init__(self, factory, name, module_name=None):
+        self._factory = factory
+        self._name = name
+        self._module_name = module_name
+        self._object = None
+        _REGISTRY.append(self)
+
+    def _load(self):
+        if self._object is None:
+            start = time.perf_counter()
+            self._object = self._factory()
+            if self._module_name is not None:
+                _IMPORT_TIMES.setdefault(self._module_name, time.perf_counter() - start)
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        return f"<lazy {self._name}>"
+
+
+def lazy_import(module_name):
+    """
+    `torch = lazy_import("torch")` is `import torch`, deferred to the first use of `torch`
+    """
+    return LazyObject(lambda: importlib.import_module(module_name), module_name, module_name)
+
+
+def _import_attr(module_name, attr):
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def lazy_from(module_name, *attrs):
+    """
+    `A, B = lazy_from("m", "A", "B")` is `from m import A, B`, deferred to the first use of `A` or `B`
+    """
+    objects = tuple(
+        LazyObject(partial(_import_attr, module_name, attr), f"{module_name}.{attr}", module_name) for attr in attrs
+    )
+    return objects[0] if len(objects) == 1 else objects
+
+
+def lazy_call(fn, *args, **kwargs):
+    """
+    `x = lazy_call(f, ...)` is `x = f(...)`, deferred to the first use of `x`
+    """
+    return LazyObject(lambda: fn(*args, **kwargs), f"{fn!r}(...)")
+
+
+def import_profile():
+    """
+    imports every module declared lazily so far, and returns (module, seconds) pairs sorted by cost. The time of a
+    module only counts what was not already imported by an earlier one.
+    """
+    for lazy_object in _REGISTRY:
+        lazy_object._load()
+    return sorted(_IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True)
@@ -21,53 +21,134 @@ import math
 import os
 import random
 import shutil
-from contextlib import nullcontext
+import subprocess
+import sys
+import time
+import traceback
 from pathlib import Path
 import warnings
 
-
-
-import accelerate
-import datasets
-import numpy as np
-import torch
-import torch.nn.functional as F
-import torch.utils.checkpoint
-import transformers
-from accelerate import Accelerator
-from accelerate.logging import get_logger
-from accelerate.state import AcceleratorState
-from accelerate.utils import ProjectConfiguration, set_seed
-from datasets import load_dataset
-from huggingface_hub import create_repo, upload_folder
-from packaging import version
-from torchvision import transforms
-from tqdm.auto import tqdm
-from transformers import CLIPTextModel, CLIPTokenizer
-from transformers.utils import ContextManagers
-
-import diffusers
-from diffusers import AutoencoderKL, DDPMScheduler, StableDiffusionPipeline, UNet2DConditionModel
-from diffusers.optimization import get_scheduler
-from diffusers.training_utils import EMAModel, compute_dream_and_update_latents, compute_snr
-from diffusers.utils import check_min_version, deprecate, is_wandb_available, make_image_grid
-from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
-from diffusers.utils.import_utils import is_xformers_available
-from diffusers.utils.torch_utils import is_compiled_module
+from lazy_imports import import_profile, lazy_call, lazy_from, lazy_import
+from profiling import parse_step_window
+
+
+# Everything below is imported on first use: parsing and validating the arguments (`--help`, bad arguments, or a
+# launcher checking a config with `parse_args`) never waits for torch, diffusers & co, and optional integrations are
+# only imported when their flags are set. `--import_profile` reports what the imports cost.
+accelerate = lazy_import("accelerate")
+datasets = lazy_import("datasets")
+np = lazy_import("numpy")
+torch = lazy_import("torch")
+F = lazy_import("torch.nn.functional")
+transformers = lazy_import("transformers")
+Accelerator = lazy_from("accelerate", "Accelerator")
+get_logger = lazy_from("accelerate.logging", "get_logger")
+AcceleratorState = lazy_from("accelerate.state", "AcceleratorState")
+ProjectConfiguration, set_seed = lazy_from("accelerate.utils", "ProjectConfiguration", "set_seed")
+load_dataset = lazy_from("datasets", "load_dataset")
+create_repo, upload_folder = lazy_from("huggingface_hub", "create_repo", "upload_folder")
+version = lazy_from("packaging", "version")
+transforms = lazy_from("torchvision", "transforms")
+tqdm = lazy_from("tqdm.auto", "tqdm")
+CLIPTextModel, CLIPTokenizer = lazy_from("transformers", "CLIPTextModel", "CLIPTokenizer")
+ContextManagers = lazy_from("transformers.utils", "ContextManagers")
+
+diffusers = lazy_import("diffusers")
+AutoencoderKL, DDPMScheduler, UNet2DConditionModel = lazy_from(
+    "diffusers", "AutoencoderKL", "DDPMScheduler", "UNet2DConditionModel"
+)
+get_scheduler = lazy_from("diffusers.optimization", "get_scheduler")
+EMAModel, compute_dream_and_update_latents, compute_snr = lazy_from(
+    "diffusers.training_utils", "EMAModel", "compute_dream_and_update_latents", "compute_snr"
+)
+deprecate, make_image_grid = lazy_from("diffusers.utils", "deprecate", "make_image_grid")
+load_or_create_model_card, populate_model_card = lazy_from(
+    "diffusers.utils.hub_utils", "load_or_create_model_card", "populate_model_card"
+)
+is_xformers_available = lazy_from("diffusers.utils.import_utils", "is_xformers_available")
+is_compiled_module = lazy_from("diffusers.utils.torch_utils", "is_compiled_module")
+
+checkpointing = lazy_import("checkpointing")
+(
+    AsyncCheckpointWriter,
+    PreemptionHandler,
+    has_safetensors,
+    list_checkpoints,
+    load_safetensors_into,
+    read_sampler_state,
+) = lazy_from(
+    "checkpointing",
+    "AsyncCheckpointWriter",
+    "PreemptionHandler",
+    "has_safetensors",
+    "list_checkpoints",
+    "load_safetensors_into",
+    "read_sampler_state",
+)
+(
+    CaptionIndexedDataset,
+    CaptionTokenIndex,
+    ImageCacheDataset,
+    LatentCacheDataset,
+    build_bucket_cache,
+    build_caption_cache,
+    build_image_cache,
+    build_latent_cache,
+    cache_fingerprint,
+    caption_variants,
+    read_bucket_cache,
+    read_cache_index,
+    sample_cached_latents,
+) = lazy_from(
+    "data_cache",
+    "CaptionIndexedDataset",
+    "CaptionTokenIndex",
+    "ImageCacheDataset",
+    "LatentCacheDataset",
+    "build_bucket_cache",
+    "build_caption_cache",
+    "build_image_cache",
+    "build_latent_cache",
+    "cache_fingerprint",
+    "caption_variants",
+    "read_bucket_cache",
+    "read_cache_index",
+    "sample_cached_latents",
+)
+BatchPrefetcher, BucketBatchSampler, augment_on_device, make_buckets, resize_to_cover = lazy_from(
+    "data_utils", "BatchPrefetcher", "BucketBatchSampler", "augment_on_device", "make_buckets", "resize_to_cover"
+)
+ComponentLoader, resolve_weight_file = lazy_from("model_loading", "ComponentLoader", "resolve_weight_file")
+StepTimer = lazy_from("profiling", "StepTimer")
+StreamingDataset, StreamingEpochs, decode_image, prepare_stream = lazy_from(
+    "streaming", "StreamingDataset", "StreamingEpochs", "decode_image", "prepare_stream"
+)
+is_tar_shard_dir, load_tar_shards = lazy_from("tar_shards", "is_tar_shard_dir", "load_tar_shards")
+EMAUpdater, MetricsAccumulator, TextEmbeddingCache, caption_key = lazy_from(
+    "train_utils", "EMAUpdater", "MetricsAccumulator", "TextEmbeddingCache", "caption_key"
+)
+RunStatus = lazy_from("run_status", "RunStatus")
+ValidationEngine = lazy_from("validation", "ValidationEngine")
+batch_size_search = lazy_import("batch_size_search")
 
 warnings.filterwarnings("ignore", category=FutureWarning)
-transformers.logging.set_verbosity_error()
-
-
 
-# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
 
-logger = get_logger(__name__, log_level="INFO")
+logger = lazy_call(get_logger, __name__, log_level="INFO")
 
 DATASET_NAME_MAPPING = {
     "lambdalabs/naruto-blip-captions": ("image", "text"),
 }
 
+# Exit code of a run that ran out of device memory, so that a scheduler can requeue it with more room. running.py
+# keeps its own copy of this value.
+OUT_OF_MEMORY_EXIT_CODE = 86
+
+# The EMAModel state that `EMAModel.save_pretrained` stores in the config of the EMA UNet.
+EMA_STATE_KEYS = (
+    "decay", "min_decay", "optimization_step", "update_after_step", "use_ema_warmup", "inv_gamma", "power"
+)
+
 
 def save_model_card(
     args,
@@ -133,54 +214,279 @@ These are the key hyperparameters used during training:
     model_card.save(os.path.join(repo_folder, "README.md"))
 
 
-def log_validation(vae, text_encoder, tokenizer, unet, args, accelerator, weight_dtype, epoch):
+def log_validation(validation_engine, accelerator, epoch):
     logger.info("Running validation... ")
 
-    pipeline = StableDiffusionPipeline.from_pretrained(
-        args.pretrained_model_name_or_path,
-        vae=accelerator.unwrap_model(vae),
-        text_encoder=accelerator.unwrap_model(text_encoder),
-        tokenizer=tokenizer,
-        unet=accelerator.unwrap_model(unet),
-        safety_checker=None,
-        revision=args.revision,
-        torch_dtype=weight_dtype,
-    )
-    pipeline = pipeline.to(accelerator.device)
-    pipeline.set_progress_bar_config(disable=True)
+    images = validation_engine()
 
-    if args.enable_xformers_memory_efficient_attention:
-        pipeline.enable_xformers_memory_efficient_attention()
+    for tracker in accelerator.trackers:
+        if tracker.name == "tensorboard":
+            np_images = np.stack([np.asarray(img) for img in images])
+            tracker.writer.add_images("validation", np_images, epoch, dataformats="NHWC")
 
-    if args.seed is None:
-        generator = None
-    else:
-        generator = torch.Generator(device=accelerator.device).manual_seed(args.seed)
+    return images
+
+
+def training_step(
+    args,
+    accelerator,
+    batch,
+    unet,
+    noise_scheduler,
+    optimizer,
+    lr_scheduler,
+    weight_dtype,
+    step_timer,
+    vae=None,
+    text_encoder=None,
+    text_embedding_cache=None,
+    latent_scaling_factor=None,
+    ema_updater=None,
+):
+    """
+    Runs one forward, backward and optimizer micro-step on `batch` and returns the (unreduced) loss. `vae` and
+    `text_encoder` are not needed when the batch comes from the latent cache.
+    """
+    with accelerator.accumulate(unet):
+        # Convert images to latent space
+        with step_timer.phase("vae_encode"):
+            if args.latent_cache_dir is not None:
+                latents = sample_cached_latents(batch["latent_moments"].to(weight_dtype))
+                latents = latents * latent_scaling_factor
+            else:
+                if args.gpu_augmentation:
+                    pixel_values = augment_on_device(batch["pixel_values"], args.random_flip, weight_dtype)
+                else:
+                    pixel_values = batch["pixel_values"].to(weight_dtype)
+                latents = vae.encode(pixel_values).latent_dist.sample()
+                latents = latents * latent_scaling_factor
+
+        with step_timer.phase("add_noise"):
+            # Sample noise that we'll add to the latents
+            noise = torch.randn_like(latents)
+            if args.noise_offset:
+                # https://www.crosslabs.org//blog/diffusion-with-offset-noise
+                noise += args.noise_offset * torch.randn(
+                    (latents.shape[0], latents.shape[1], 1, 1), device=latents.device
+                )
+            if args.input_perturbation:
+                new_noise = noise + args.input_perturbation * torch.randn_like(noise)
+            bsz = latents.shape[0]
+            # Sample a random timestep for each image
+            timesteps = torch.randint(
+                0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device
+            )
+            timesteps = timesteps.long()
+
+            # Add noise to the latents according to the noise magnitude at each timestep
+            # (this is the forward diffusion process)
+            if args.input_perturbation:
+                noisy_latents = noise_scheduler.add_noise(latents, new_noise, timesteps)
+            else:
+                noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+
+        # Get the text embedding for conditioning
+        with step_timer.phase("text_encode"):
+            if args.latent_cache_dir is not None:
+                encoder_hidden_states = batch["encoder_hidden_states"].to(weight_dtype)
+            elif text_embedding_cache is not None:
+                encoder_hidden_states = text_embedding_cache(batch["input_ids"], batch["caption_keys"])
+            else:
+                encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+
+        # Get the target for loss depending on the prediction type
+        if args.prediction_type is not None:
+            # set prediction_type of scheduler if defined
+            noise_scheduler.register_to_config(prediction_type=args.prediction_type)
 
-    images = []
-    for i in range(len(args.validation_prompts)):
-        if torch.backends.mps.is_available():
-            autocast_ctx = nullcontext()
+        if noise_scheduler.config.prediction_type == "epsilon":
+            target = noise
+        elif noise_scheduler.config.prediction_type == "v_prediction":
+            target = noise_scheduler.get_velocity(latents, noise, timesteps)
         else:
-            autocast_ctx = torch.autocast(accelerator.device.type)
+            raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
+
+        if args.dream_training:
+            with step_timer.phase("dream"):
+                noisy_latents, target = compute_dream_and_update_latents(
+                    unet,
+                    noise_scheduler,
+                    timesteps,
+                    noise,
+                    noisy_latents,
+                    target,
+                    encoder_hidden_states,
+                    args.dream_detail_preservation,
+                )
 
-        with autocast_ctx:
-            image = pipeline(args.validation_prompts[i], num_inference_steps=20, generator=generator).images[0]
+        # Predict the noise residual and compute loss
+        with step_timer.phase("unet_forward"):
+            model_pred = unet(noisy_latents, timesteps, encoder_hidden_states, return_dict=False)[0]
 
-        images.append(image)
+            if args.snr_gamma is None:
+                loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+            else:
+                # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
+                # Since we predict the noise instead of x_0, the original formulation is slightly changed.
+                # This is discussed in Section 4.2 of the same paper.
+                snr = compute_snr(noise_scheduler, timesteps)
+                mse_loss_weights = torch.stack(
+                    [snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1
+                ).min(dim=1)[0]
+                if noise_scheduler.config.prediction_type == "epsilon":
+                    mse_loss_weights = mse_loss_weights / snr
+                elif noise_scheduler.config.prediction_type == "v_prediction":
+                    mse_loss_weights = mse_loss_weights / (snr + 1)
+
+                loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+                loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
+                loss = loss.mean()
+
+        # Backpropagate
+        with step_timer.phase("backward"):
+            accelerator.backward(loss)
+        if accelerator.sync_gradients:
+            with step_timer.phase("grad_clip"):
+                accelerator.clip_grad_norm_(unet.parameters(), args.max_grad_norm)
+        with step_timer.phase("optimizer_step"):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+        if ema_updater is not None and accelerator.sync_gradients:
+            with step_timer.phase("ema_update"):
+                ema_updater.step(unet.parameters())
+
+    return loss
+
+
+def find_batch_size(
+    args, accelerator, unet, optimizer, noise_scheduler, tokenizer, weight_dtype, vae=None, text_encoder=None
+):
+    """
+    `--auto_batch_size`: sets `args.train_batch_size` to the largest micro-batch that fits on the device, from the
+    cache or from a search over training steps on synthetic batches, and `args.gradient_accumulation_steps` so that
+    the effective batch stays the same. `vae` and `text_encoder` are None with a latent cache.
+    """
+    device = accelerator.device
+    if device.type != "cuda":
+        logger.warning("`--auto_batch_size` needs a CUDA device, keeping `--train_batch_size`.")
+        return
+    effective_batch_size = args.train_batch_size * args.gradient_accumulation_steps
+    # Everything that changes the memory of a training step.
+    config = {
+        "model": args.pretrained_model_name_or_path,
+        "revision": args.non_ema_revision,
+        "resolution": args.resolution,
+        "mixed_precision": accelerator.mixed_precision,
+        "gradient_checkpointing": args.gradient_checkpointing,
+        "use_8bit_adam": args.use_8bit_adam,
+        "xformers": args.enable_xformers_memory_efficient_attention,
+        "ema": "offload" if args.use_ema and args.offload_ema else args.use_ema,
+        "latent_cache": args.latent_cache_dir is not None,
+        "dream_training": args.dream_training,
+        "text_embedding_cache_mb": args.text_embedding_cache_mb if args.latent_cache_dir is None else 0,
+        "gpu_augmentation": args.gpu_augmentation,
+        "distributed": accelerator.num_processes > 1,
+        "device": torch.cuda.get_device_name(device),
+        "device_memory": torch.cuda.get_device_properties(device).total_memory,
+    }
+    cache_path = args.batch_size_cache or batch_size_search.DEFAULT_CACHE_PATH
+    max_batch_size = batch_size_search.cached_max_batch_size(cache_path, config, effective_batch_size)
+    if max_batch_size is not None:
+        logger.info(f"Largest micro-batch from {cache_path}: {max_batch_size}")
+    else:
+        unet.to(device)
+        learning_rates = [group["lr"] for group in optimizer.param_groups]
+        for group in optimizer.param_groups:
+            # The optimizer steps of the search must not move the weights.
+            group["lr"] = 0.0
+        # Memory the training run holds next to the steps, taken for the duration of the search: with several
+        # processes DDP keeps a flat copy of the gradients for the all-reduce, and the text embedding cache fills up
+        # to its budget.
+        reserved = []
+        if accelerator.num_processes > 1:
+            reserved.append(torch.empty(sum(p.numel() for p in unet.parameters() if p.requires_grad), device=device))
+        if args.latent_cache_dir is None and args.text_embedding_cache_mb > 0:
+            reserved.append(torch.empty(int(args.text_embedding_cache_mb * 2**20), dtype=torch.uint8, device=device))
+        latent_size = args.resolution // (2 ** (len(vae.config.block_out_channels) - 1) if vae is not None else 8)
+
+        def step(batch_size):
+            try:
+                with torch.no_grad():
+                    if vae is None:
+                        latents = torch.randn(
+                            batch_size,
+                            unet.config.in_channels,
+                            latent_size,
+                            latent_size,
+                            device=device,
+                            dtype=weight_dtype,
+                        )
+                        encoder_hidden_states = torch.randn(
+                            batch_size,
+                            tokenizer.model_max_length,
+                            unet.config.cross_attention_dim,
+                            device=device,
+                            dtype=weight_dtype,
+                        )
+                    else:
+                        pixel_values = torch.randn(
+                            batch_size, 3, args.resolution, args.resolution, device=device, dtype=weight_dtype
+                        )
+                        latents = vae.encode(pixel_values).latent_dist.sample()
+                        input_ids = torch.randint(
+                            0, tokenizer.vocab_size, (batch_size, tokenizer.model_max_length), device=device
+                        )
+                        encoder_hidden_states = text_encoder(input_ids, return_dict=False)[0]
+                timesteps = torch.randint(
+                    0, noise_scheduler.config.num_train_timesteps, (batch_size,), device=device
+                )
+                with accelerator.autocast():
+                    model_pred = unet(latents, timesteps, encoder_hidden_states, return_dict=False)[0]
+                F.mse_loss(model_pred.float(), torch.randn_like(model_pred, dtype=torch.float32)).backward()
+                optimizer.step()
+            finally:
+                optimizer.zero_grad(set_to_none=True)
 
-    for tracker in accelerator.trackers:
-        
-        np_images = np.stack([np.asarray(img) for img in images])
-        tracker.writer.add_images("validation", np_images, epoch, dataformats="NHWC")
+        # The search draws random numbers, a run that reads the cache must see the same ones.
+        with torch.random.fork_rng(devices=[device]):
+            max_batch_size = batch_size_search.find_max_batch_size(
+                lambda batch_size: batch_size_search.fits_in_memory(step, batch_size), effective_batch_size
+            )
+        for group, learning_rate in zip(optimizer.param_groups, learning_rates):
+            group["lr"] = learning_rate
+        # The optimizer states are created again at the first real step.
+        optimizer.state.clear()
+        reserved.clear()
+        torch.cuda.empty_cache()
+        # Every process searched on its own device, they all have to use the same batch size.
+        max_batch_size = int(accelerator.gather(torch.tensor([max_batch_size], device=device)).min())
+        if accelerator.is_main_process:
+            batch_size_search.write_batch_size_cache(cache_path, config, max_batch_size, effective_batch_size)
+        logger.info(f"Largest micro-batch that fits: {max_batch_size}")
+
+    args.train_batch_size, args.gradient_accumulation_steps = batch_size_search.split_batch(
+        effective_batch_size, max_batch_size
+    )
+    accelerator.gradient_accumulation_steps = args.gradient_accumulation_steps
+    logger.info(
+        f"Training with micro-batches of {args.train_batch_size} and {args.gradient_accumulation_steps} gradient"
+        f" accumulation steps (effective batch {effective_batch_size} per process)"
+    )
 
-    del pipeline
-    torch.cuda.empty_cache()
 
-    return images
+def resume_checkpoint_name(args):
+    """
+    returns the name of the checkpoint directory `--resume_from_checkpoint` refers to, None if there is none yet
+    """
+    if args.resume_from_checkpoint != "latest":
+        return os.path.basename(args.resume_from_checkpoint)
+    # Get the most recent checkpoint
+    dirs = list_checkpoints(args.output_dir)
+    return dirs[-1] if len(dirs) > 0 else None
 
 
-def parse_args():
+def parse_args(input_args=None):
     parser = argparse.ArgumentParser(description="Simple example of a training script.")
     parser.add_argument(
         "--input_perturbation", type=float, default=0, help="The scale of input perturbation. Recommended 0.1."
@@ -228,7 +534,8 @@ def parse_args():
         help=(
             "A folder containing the training data. Folder contents must follow the structure described in"
             " https://huggingface.co/docs/datasets/image_dataset#imagefolder. In particular, a `metadata.jsonl` file"
-            " must exist to provide the captions for the images. Ignored if `dataset_name` is specified."
+            " must exist to provide the captions for the images. It can also be a directory of tar shards written by"
+            " tar_shards.py. Ignored if `dataset_name` is specified."
         ),
     )
     parser.add_argument(
@@ -249,6 +556,24 @@ def parse_args():
             "value if set."
         ),
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Stream the dataset (`load_dataset(..., streaming=True)`) instead of converting it to Arrow before"
+            " training. Samples are shuffled in a buffer of `--shuffle_buffer_size` examples and decoded in the"
+            " dataloader workers. The run lasts `--max_train_steps`; an epoch is a full pass when the dataset declares"
+            " its number of examples, otherwise the whole run is one epoch. `--max_train_samples` keeps the first"
+            " samples of the stream. Cannot be combined with `--aspect_ratio_buckets`, `--latent_cache_dir` or"
+            " `--image_cache_dir`."
+        ),
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=1000,
+        help="Number of examples of the shuffle buffer of every dataloader worker with `--streaming`.",
+    )
     parser.add_argument(
         "--validation_prompts",
         type=str,
@@ -268,7 +593,45 @@ def parse_args():
         default=None,
         help="The directory where the downloaded models and datasets will be stored.",
     )
-    parser.add_argument("--seed", type=int, default=None, help="A seed for reproducible training.")
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "If set, the VAE latent distributions and text encoder hidden states of the training set are computed"
+            " once and stored in memory-mapped shards under this directory. Training then samples latents from the"
+            " cache and never loads the VAE or the text encoder."
+        ),
+    )
+    parser.add_argument(
+        "--text_embedding_cache_mb",
+        type=float,
+        default=0,
+        help=(
+            "Memory budget in MB of an on-device LRU cache of text encoder outputs keyed by the caption tokens, so"
+            " that repeated captions are only encoded once. 0 disables the cache."
+            " Ignored if `--latent_cache_dir` is set."
+        ),
+    )
+    parser.add_argument(
+        "--image_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "If set, the training images are decoded and resized to `--resolution` once and stored as a contiguous"
+            " uint8 memory-mapped file under this directory, so that the dataloader only slices crops out of it."
+            " Ignored if `--latent_cache_dir` is set."
+        ),
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help=(
+            "A seed for reproducible training. Without it, the data order is shuffled with a random seed, which is"
+            " saved with the checkpoints so that a resumed run keeps it."
+        ),
+    )
     parser.add_argument(
         "--resolution",
         type=int,
@@ -287,11 +650,34 @@ def parse_args():
             " cropped. The images will be resized to the resolution first before cropping."
         ),
     )
+    parser.add_argument(
+        "--aspect_ratio_buckets",
+        action="store_true",
+        help=(
+            "Whether to group the images into buckets of different aspect ratios with about `--resolution` squared"
+            " pixels each, instead of resizing and cropping every image to a `--resolution` square. Every batch is"
+            " drawn from a single bucket."
+        ),
+    )
+    parser.add_argument(
+        "--bucket_step",
+        type=int,
+        default=64,
+        help="The side lengths of the aspect ratio buckets are multiples of this value.",
+    )
     parser.add_argument(
         "--random_flip",
         action="store_true",
         help="whether to randomly flip images horizontally",
     )
+    parser.add_argument(
+        "--gpu_augmentation",
+        action="store_true",
+        help=(
+            "Whether to only resize and crop the images in the dataloader workers and transfer them as uint8. The"
+            " random flip, normalization and cast to the training dtype then run as one batched op on the device."
+        ),
+    )
     parser.add_argument(
         "--train_batch_size", type=int, default=16, help="Batch size (per device) for the training dataloader."
     )
@@ -308,6 +694,22 @@ def parse_args():
         default=1,
         help="Number of updates steps to accumulate before performing a backward/update pass.",
     )
+    parser.add_argument(
+        "--auto_batch_size",
+        action="store_true",
+        help=(
+            "Find the largest micro-batch that fits on the GPU with the current flags, by running training steps on"
+            " synthetic batches, and train with it. `--gradient_accumulation_steps` is then set so that the effective"
+            " batch `--train_batch_size` x `--gradient_accumulation_steps` stays the same. The result is cached per"
+            " model, config and device in `--batch_size_cache`."
+        ),
+    )
+    parser.add_argument(
+        "--batch_size_cache",
+        type=str,
+        default=None,
+        help="JSON file of the `--auto_batch_size` results. Defaults to ~/.cache/quick_sd/batch_sizes.json.",
+    )
     parser.add_argument(
         "--gradient_checkpointing",
         action="store_true",
@@ -348,8 +750,8 @@ def parse_args():
         "--dream_training",
         action="store_true",
         help=(
-            "Use the DREAM training method, which makes training more efficient and accurate at the ",
-            "expense of doing an extra forward pass. See: https://arxiv.org/abs/2312.00210",
+            "Use the DREAM training method, which makes training more efficient and accurate at the "
+            "expense of doing an extra forward pass. See: https://arxiv.org/abs/2312.00210"
         ),
     )
     parser.add_argument(
@@ -372,6 +774,15 @@ def parse_args():
     parser.add_argument("--use_ema", action="store_true", help="Whether to use EMA model.")
     parser.add_argument("--offload_ema", action="store_true", help="Offload EMA model to CPU during training step.")
     parser.add_argument("--foreach_ema", action="store_true", help="Use faster foreach implementation of EMAModel.")
+    parser.add_argument(
+        "--ema_update_every",
+        type=int,
+        default=1,
+        help=(
+            "Update the EMA every X optimizer steps, with the decay adjusted to keep the same averaging horizon. With"
+            " `--offload_ema` the updates run on a background thread."
+        ),
+    )
     parser.add_argument(
         "--non_ema_revision",
         type=str,
@@ -390,6 +801,24 @@ def parse_args():
             "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
         ),
     )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=None,
+        help=(
+            "Number of batches loaded in advance by each dataloader worker. Only used if `--dataloader_num_workers`"
+            " > 0."
+        ),
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=0,
+        help=(
+            "Number of batches to fetch and copy to the device ahead of the training step on a background thread"
+            " (and a side CUDA stream). 0 disables prefetching."
+        ),
+    )
     parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
     parser.add_argument("--adam_beta2", type=float, default=0.999, help="The beta2 parameter for the Adam optimizer.")
     parser.add_argument("--adam_weight_decay", type=float, default=1e-2, help="Weight decay to use.")
@@ -429,6 +858,41 @@ def parse_args():
             " flag passed with the `accelerate.launch` command. Use this argument to override the accelerate config."
         ),
     )
+    parser.add_argument(
+        "--log_every_n_steps",
+        type=int,
+        default=10,
+        help=(
+            "Log the training metrics every X updates. Metrics are accumulated on the device in between, so that the"
+            " training step does not wait for the device or the other processes."
+        ),
+    )
+    parser.add_argument(
+        "--status_dir",
+        type=str,
+        default=None,
+        help=(
+            "Keep a JSON status file of this run (PID, step, samples/sec, loss, last update) in this directory,"
+            " updated whenever the metrics are logged. `python running.py status` shows the runs of a host."
+        ),
+    )
+    parser.add_argument(
+        "--step_timing",
+        action="store_true",
+        help=(
+            "Time the data wait and every phase of each training step (VAE encode, text encode, noise, DREAM, UNet"
+            " forward, backward, gradient clipping, optimizer step) and append them to `output_dir/step_timing.jsonl`."
+        ),
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=str,
+        default=None,
+        help=(
+            "A `start:end` window of training steps (end excluded) to record with torch.profiler. The chrome trace is"
+            " written to `output_dir`."
+        ),
+    )
     parser.add_argument(
         "--report_to",
         type=str,
@@ -454,6 +918,28 @@ def parse_args():
         default=None,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--preemption_grace_period",
+        type=float,
+        default=60,
+        help=(
+            "On SIGTERM or SIGUSR1 the current optimizer step is finished, an emergency checkpoint is written and the"
+            " run exits with code 75, to be relaunched with `--resume_from_checkpoint latest`. If that takes longer"
+            " than this many seconds the run exits right away. 0 waits for the checkpoint however long it takes."
+            " With several processes the signal is acted on at the next step that logs metrics"
+            " (`--log_every_n_steps`) or saves a checkpoint."
+        ),
+    )
+    parser.add_argument(
+        "--preemption_checkpoint",
+        type=str,
+        default="minimal",
+        choices=["minimal", "full"],
+        help=(
+            "What the emergency checkpoint contains. `minimal` skips the EMA weights (the EMA is restarted from the"
+            " UNet weights on resume); `full` is a regular checkpoint."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -467,6 +953,29 @@ def parse_args():
         "--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers."
     )
     parser.add_argument("--noise_offset", type=float, default=0, help="The scale of noise offset.")
+    parser.add_argument(
+        "--validation_batch_size",
+        type=int,
+        default=None,
+        help=(
+            "Max number of validation prompts denoised together. Defaults to all of them; on CUDA the batch is split"
+            " further if it runs out of memory."
+        ),
+    )
+    parser.add_argument(
+        "--validation_worker",
+        action="store_true",
+        help=(
+            "Render the validation prompts in a separate process (validation.py) that picks up every new"
+            " `checkpoint-N`, instead of pausing training every `--validation_epochs`."
+        ),
+    )
+    parser.add_argument(
+        "--validation_worker_device",
+        type=str,
+        default=None,
+        help="Device of the validation worker. Defaults to cuda if available, else cpu.",
+    )
     parser.add_argument(
         "--validation_epochs",
         type=int,
@@ -483,7 +992,17 @@ def parse_args():
         ),
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--import_profile",
+        action="store_true",
+        help="Print how long importing each of the (lazily imported) dependencies takes before training starts.",
+    )
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
         args.local_rank = env_local_rank
@@ -492,6 +1011,28 @@ def parse_args():
     if args.dataset_name is None and args.train_data_dir is None:
         raise ValueError("Need either a dataset name or a training folder.")
 
+    if args.report_to == "wandb" and args.hub_token is not None:
+        raise ValueError(
+            "You cannot use both --report_to=wandb and --hub_token due to a security risk of exposing your token."
+            " Please use `huggingface-cli login` to authenticate with the Hub."
+        )
+
+    if args.aspect_ratio_buckets and (args.latent_cache_dir is not None or args.image_cache_dir is not None):
+        raise ValueError(
+            "`--aspect_ratio_buckets` cannot be combined with `--latent_cache_dir` or `--image_cache_dir`."
+        )
+
+    if args.streaming and (
+        args.aspect_ratio_buckets or args.latent_cache_dir is not None or args.image_cache_dir is not None
+    ):
+        raise ValueError(
+            "`--streaming` cannot be combined with `--aspect_ratio_buckets`, `--latent_cache_dir` or"
+            " `--image_cache_dir`, which all need a pass over the whole dataset."
+        )
+
+    if args.profile_steps is not None:
+        parse_step_window(args.profile_steps)
+
     # default to using the same revision for the non-ema model if not specified
     if args.non_ema_revision is None:
         args.non_ema_revision = args.revision
@@ -500,13 +1041,14 @@ def parse_args():
 
 
 def main():
+    main_start = time.perf_counter()
     args = parse_args()
 
-    if args.report_to == "wandb" and args.hub_token is not None:
-        raise ValueError(
-            "You cannot use both --report_to=wandb and --hub_token due to a security risk of exposing your token."
-            " Please use `huggingface-cli login` to authenticate with the Hub."
-        )
+    if args.import_profile:
+        print(f"{'module':<32}{'import s':>10}")
+        for module_name, seconds in import_profile():
+            print(f"{module_name:<32}{seconds:>10.3f}")
+    transformers.logging.set_verbosity_error()
 
     if args.non_ema_revision is not None:
         deprecate(
@@ -522,6 +1064,7 @@ def main():
     accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
 
     accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
         mixed_precision=args.mixed_precision,
         log_with=args.report_to,
         project_config=accelerator_project_config,
@@ -551,6 +1094,20 @@ def main():
     if args.seed is not None:
         set_seed(args.seed)
 
+    # The data order (shuffling, caption choice, dataloader worker seeds) is a function of this seed only. Without
+    # `--seed` every run draws its own, and a resumed run takes the one saved with its checkpoint.
+    data_seed = args.seed
+    if data_seed is None:
+        checkpoint = resume_checkpoint_name(args) if args.resume_from_checkpoint else None
+        sampler_state = read_sampler_state(os.path.join(args.output_dir, checkpoint)) if checkpoint else None
+        if sampler_state is not None:
+            # Stream checkpoints written before the seed was saved with them used 0.
+            data_seed = sampler_state.get("seed", 0)
+        else:
+            # Every process has to shuffle the same way.
+            data_seed = accelerate.utils.broadcast_object_list([random.SystemRandom().getrandbits(32)])[0]
+        logger.info(f"No `--seed` given, the data order uses seed {data_seed}")
+
     # Handle the repository creation
     if accelerator.is_main_process:
         if args.output_dir is not None:
@@ -561,10 +1118,39 @@ def main():
                 repo_id=args.hub_model_id or Path(args.output_dir).name, exist_ok=True, token=args.hub_token
             ).repo_id
 
-    # Load scheduler, tokenizer and models.
-    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
-    tokenizer = CLIPTokenizer.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision
+    # For mixed precision training we cast all non-trainable weights (vae, non-lora text_encoder and non-lora unet) to half-precision
+    # as these weights are only used for inference, keeping weights in full precision is not required.
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+        args.mixed_precision = accelerator.mixed_precision
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+        args.mixed_precision = accelerator.mixed_precision
+
+    # Load scheduler, tokenizer and models. The weight files are read and the tokenizer and scheduler are loaded on a
+    # thread pool while the models are built.
+    component_loader = ComponentLoader()
+    model_subfolders = ["unet"] if args.latent_cache_dir is not None else ["text_encoder", "vae", "unet"]
+    component_loader.prefetch(
+        [
+            resolve_weight_file(
+                args.pretrained_model_name_or_path,
+                subfolder,
+                revision=args.non_ema_revision if subfolder == "unet" else args.revision,
+            )
+            for subfolder in model_subfolders
+        ]
+    )
+    noise_scheduler = component_loader.submit(
+        "noise_scheduler", DDPMScheduler.from_pretrained, args.pretrained_model_name_or_path, subfolder="scheduler"
+    )
+    tokenizer = component_loader.submit(
+        "tokenizer",
+        CLIPTokenizer.from_pretrained,
+        args.pretrained_model_name_or_path,
+        subfolder="tokenizer",
+        revision=args.revision,
     )
 
     def deepspeed_zero_init_disabled_context_manager():
@@ -586,28 +1172,60 @@ def main():
     # frozen models from being partitioned during `zero.Init` which gets called during
     # `from_pretrained` So CLIPTextModel and AutoencoderKL will not enjoy the parameter sharding
     # across multiple gpus and only UNet2DConditionModel will get ZeRO sharded.
-    with ContextManagers(deepspeed_zero_init_disabled_context_manager()):
-        text_encoder = CLIPTextModel.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision, 
-        )
-        vae = AutoencoderKL.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision, 
-        )
-
-    unet = UNet2DConditionModel.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="unet", revision=args.non_ema_revision
+    def load_frozen_models():
+        # The frozen models are loaded straight in `weight_dtype` (and on the GPU), without an fp32 copy on the host.
+        frozen_kwargs = {"revision": args.revision, "torch_dtype": weight_dtype}
+        if accelerator.device.type == "cuda" and not deepspeed_zero_init_disabled_context_manager():
+            frozen_kwargs["device_map"] = {"": accelerator.device}
+        with ContextManagers(deepspeed_zero_init_disabled_context_manager()):
+            text_encoder = component_loader.load(
+                "text_encoder",
+                CLIPTextModel.from_pretrained,
+                args.pretrained_model_name_or_path,
+                subfolder="text_encoder",
+                **frozen_kwargs,
+            )
+            vae = component_loader.load(
+                "vae",
+                AutoencoderKL.from_pretrained,
+                args.pretrained_model_name_or_path,
+                subfolder="vae",
+                **frozen_kwargs,
+            )
+        vae.requires_grad_(False)
+        text_encoder.requires_grad_(False)
+        return text_encoder, vae
+
+    # With a latent cache the frozen models are only needed to build the cache, see below.
+    text_encoder = vae = None
+    if args.latent_cache_dir is None:
+        text_encoder, vae = load_frozen_models()
+
+    unet = component_loader.load(
+        "unet",
+        UNet2DConditionModel.from_pretrained,
+        args.pretrained_model_name_or_path,
+        subfolder="unet",
+        revision=args.non_ema_revision,
     )
+    noise_scheduler = noise_scheduler.result()
+    tokenizer = tokenizer.result()
+    logger.info(f"Loaded the scheduler, tokenizer and models in {component_loader.summary()}")
 
-    # Freeze vae and text_encoder and set unet to trainable
-    vae.requires_grad_(False)
-    text_encoder.requires_grad_(False)
+    # Set unet to trainable
     unet.train()
+    if args.gradient_checkpointing:
+        unet.enable_gradient_checkpointing()
 
     # Create EMA for the unet.
     if args.use_ema:
-        ema_unet = UNet2DConditionModel.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, 
-        )
+        if args.revision != args.non_ema_revision:
+            ema_unet = UNet2DConditionModel.from_pretrained(
+                args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, 
+            )
+        else:
+            # Same weights as the trained UNet, EMAModel copies its parameters.
+            ema_unet = unet
         ema_unet = EMAModel(
             ema_unet.parameters(),
             model_cls=UNet2DConditionModel,
@@ -643,20 +1261,17 @@ def main():
                     weights.pop()
 
         def load_model_hook(models, input_dir):
-            if args.use_ema:
-                load_model = EMAModel.from_pretrained(
-                    os.path.join(input_dir, "unet_ema"), UNet2DConditionModel, foreach=args.foreach_ema
-                )
-                ema_unet.load_state_dict(load_model.state_dict())
-                if args.offload_ema:
-                    ema_unet.pin_memory()
-                else:
-                    ema_unet.to(accelerator.device)
-                del load_model
-
+            # Weights are copied straight from the memory-mapped safetensors files into the live parameters, so
+            # resuming never holds a second UNet in memory.
             for _ in range(len(models)):
                 # pop models so that they are not loaded again
-                model = models.pop()
+                model = accelerator.unwrap_model(models.pop())
+                unet_dir = os.path.join(input_dir, "unet")
+                if has_safetensors(unet_dir):
+                    config = UNet2DConditionModel.load_config(unet_dir)
+                    model.register_to_config(**{k: v for k, v in config.items() if not k.startswith("_")})
+                    load_safetensors_into(model.state_dict(), unet_dir)
+                    continue
 
                 # load diffusers style into model
                 load_model = UNet2DConditionModel.from_pretrained(input_dir, subfolder="unet")
@@ -665,6 +1280,35 @@ def main():
                 model.load_state_dict(load_model.state_dict())
                 del load_model
 
+            if args.use_ema:
+                ema_dir = os.path.join(input_dir, "unet_ema")
+                named_shadow_params = {
+                    name: shadow
+                    for (name, _), shadow in zip(
+                        accelerator.unwrap_model(unet).named_parameters(), ema_unet.shadow_params
+                    )
+                }
+                if not os.path.isdir(ema_dir):
+                    # Minimal emergency checkpoints have no EMA weights.
+                    logger.warning(f"No EMA weights in {input_dir}, restarting the EMA from the UNet weights.")
+                    with torch.no_grad():
+                        for name, param in accelerator.unwrap_model(unet).named_parameters():
+                            named_shadow_params[name].copy_(param)
+                elif has_safetensors(ema_dir):
+                    # `save_pretrained` registers the EMA state in the UNet config, `from_pretrained` reads it back.
+                    ema_config = UNet2DConditionModel.load_config(ema_dir)
+                    ema_unet.load_state_dict({k: ema_config[k] for k in EMA_STATE_KEYS if k in ema_config})
+                    load_safetensors_into(named_shadow_params, ema_dir)
+                else:
+                    load_model = EMAModel.from_pretrained(ema_dir, UNet2DConditionModel, foreach=args.foreach_ema)
+                    ema_unet.load_state_dict(load_model.state_dict())
+                    if args.offload_ema:
+                        if torch.cuda.is_available():
+                            ema_unet.pin_memory()
+                    else:
+                        ema_unet.to(accelerator.device)
+                    del load_model
+
         accelerator.register_save_state_pre_hook(save_model_hook)
         accelerator.register_load_state_pre_hook(load_model_hook)
 
@@ -700,11 +1344,28 @@ def main():
         eps=args.adam_epsilon,
     )
 
+    if args.auto_batch_size:
+        if args.use_ema and not args.offload_ema:
+            # Where it is moved anyway further down; its memory counts for the search.
+            ema_unet.to(accelerator.device)
+        find_batch_size(
+            args,
+            accelerator,
+            unet,
+            optimizer,
+            noise_scheduler,
+            tokenizer,
+            weight_dtype,
+            vae=vae,
+            text_encoder=text_encoder,
+        )
+
     # Get the datasets: you can either provide your own training and evaluation files (see below)
     # or specify a Dataset from the hub (the dataset will be downloaded automatically from the datasets Hub).
 
     # In distributed training, the load_dataset function guarantees that only one local process can concurrently
     # download the dataset.
+    use_tar_shards = args.dataset_name is None and is_tar_shard_dir(args.train_data_dir)
     if args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         dataset = load_dataset(
@@ -712,6 +1373,16 @@ def main():
             args.dataset_config_name,
             cache_dir=args.cache_dir,
             data_dir=args.train_data_dir,
+            streaming=args.streaming,
+        )
+    elif use_tar_shards:
+        # A directory written by tar_shards.py: a few large files read front to back instead of one file per image.
+        dataset = load_tar_shards(
+            args.train_data_dir,
+            streaming=args.streaming,
+            cache_dir=args.cache_dir,
+            process_index=accelerator.process_index,
+            num_processes=accelerator.num_processes,
         )
     else:
         data_files = {}
@@ -721,6 +1392,7 @@ def main():
             "imagefolder",
             data_files=data_files,
             cache_dir=args.cache_dir,
+            streaming=args.streaming,
         )
         # See more about loading custom images at
         # https://huggingface.co/docs/datasets/v2.4.0/en/image_load#imagefolder
@@ -749,61 +1421,255 @@ def main():
             )
 
     # Preprocessing the datasets.
-    # We need to tokenize input captions and transform the images.
-    def tokenize_captions(examples, is_train=True):
-        captions = []
-        for caption in examples[caption_column]:
-            if isinstance(caption, str):
-                captions.append(caption)
-            elif isinstance(caption, (list, np.ndarray)):
-                # take a random caption if there are multiple
-                captions.append(random.choice(caption) if is_train else caption[0])
-            else:
-                raise ValueError(
-                    f"Caption column `{caption_column}` should contain either strings or lists of strings."
-                )
-        inputs = tokenizer(
-            captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+    def make_train_transforms(size):
+        if args.aspect_ratio_buckets:
+            # `size` is the (height, width) of a bucket.
+            resize = transforms.Lambda(lambda image: resize_to_cover(image, size))
+        else:
+            resize = transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR)
+        if args.gpu_augmentation:
+            # Flip and normalization happen on the device, see `augment_on_device`.
+            return transforms.Compose(
+                [
+                    resize,
+                    transforms.CenterCrop(size) if args.center_crop else transforms.RandomCrop(size),
+                    transforms.PILToTensor(),
+                ]
+            )
+        return transforms.Compose(
+            [
+                resize,
+                transforms.CenterCrop(size) if args.center_crop else transforms.RandomCrop(size),
+                transforms.RandomHorizontalFlip() if args.random_flip else transforms.Lambda(lambda x: x),
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5]),
+            ]
         )
-        return inputs.input_ids
 
-    # Preprocessing the datasets.
-    train_transforms = transforms.Compose(
-        [
-            transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
-            transforms.CenterCrop(args.resolution) if args.center_crop else transforms.RandomCrop(args.resolution),
-            transforms.RandomHorizontalFlip() if args.random_flip else transforms.Lambda(lambda x: x),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
-        ]
-    )
+    train_transforms = make_train_transforms(args.resolution)
 
     def preprocess_train(examples):
         images = [image.convert("RGB") for image in examples[image_column]]
-        examples["pixel_values"] = [train_transforms(image) for image in images]
-        examples["input_ids"] = tokenize_captions(examples)
+        if args.aspect_ratio_buckets:
+            examples["pixel_values"] = [
+                bucket_transforms[bucket](image) for image, bucket in zip(images, examples["bucket"])
+            ]
+        else:
+            examples["pixel_values"] = [train_transforms(image) for image in images]
         return examples
 
     with accelerator.main_process_first():
-        if args.max_train_samples is not None:
-            dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
-        # Set the training transforms
-        train_dataset = dataset["train"].with_transform(preprocess_train)
+        if args.max_train_samples is not None and args.streaming:
+            dataset["train"] = dataset["train"].take(args.max_train_samples)
+        elif args.max_train_samples is not None:
+            dataset["train"] = dataset["train"].shuffle(seed=data_seed).select(range(args.max_train_samples))
+
+    # Derived per-sample data (bucket assignment, tokenized captions) is stored next to the dataset's own Arrow cache
+    # when there is one.
+    cache_files = [] if args.streaming else dataset["train"].cache_files
+    dataset_cache_root = os.path.dirname(cache_files[0]["filename"]) if cache_files else args.output_dir
+
+    train_sampler = None
+    if args.aspect_ratio_buckets:
+        buckets = make_buckets(args.resolution, step=args.bucket_step)
+        bucket_cache_dir = os.path.join(
+            dataset_cache_root,
+            "buckets-"
+            + cache_fingerprint(
+                kind="buckets",
+                dataset_fingerprint=dataset["train"]._fingerprint,
+                image_column=image_column,
+                buckets=buckets,
+            ),
+        )
+        with accelerator.main_process_first():
+            if accelerator.is_main_process and read_cache_index(bucket_cache_dir) is None:
+                logger.info(f"Assigning images to aspect ratio buckets in {bucket_cache_dir}")
+                build_bucket_cache(
+                    bucket_cache_dir,
+                    dataset["train"],
+                    image_column,
+                    buckets,
+                    progress_bar=tqdm(total=len(dataset["train"]), desc="Buckets"),
+                )
+            buckets, bucket_ids = read_bucket_cache(bucket_cache_dir)
+        bucket_transforms = [make_train_transforms(size) for size in buckets]
+        dataset["train"] = dataset["train"].add_column("bucket", bucket_ids.tolist())
+        train_sampler = BucketBatchSampler(bucket_ids, args.train_batch_size, seed=data_seed)
+
+    if args.streaming:
+        # Streamed tar shards are already split between the processes by `load_tar_shards`.
+        train_dataset = prepare_stream(
+            dataset["train"],
+            image_column,
+            0 if use_tar_shards else accelerator.process_index,
+            1 if use_tar_shards else accelerator.num_processes,
+            seed=data_seed,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+        )
+    else:
+        with accelerator.main_process_first():
+            # Set the training transforms
+            train_dataset = dataset["train"].with_transform(preprocess_train)
+
+    if args.latent_cache_dir is not None:
+        latent_cache_dir = os.path.join(
+            args.latent_cache_dir,
+            cache_fingerprint(
+                kind="latents",
+                model=args.pretrained_model_name_or_path,
+                revision=args.revision,
+                dataset=args.dataset_name or args.train_data_dir,
+                dataset_config=args.dataset_config_name,
+                dataset_fingerprint=dataset["train"]._fingerprint,
+                image_column=image_column,
+                caption_column=caption_column,
+                resolution=args.resolution,
+                center_crop=args.center_crop,
+                random_flip=args.random_flip,
+                weight_dtype=str(weight_dtype),
+            ),
+        )
+        with accelerator.main_process_first():
+            if accelerator.is_main_process and read_cache_index(latent_cache_dir) is None:
+                logger.info(f"Building latent cache in {latent_cache_dir}")
+                text_encoder, vae = load_frozen_models()
+                text_encoder.to(accelerator.device, dtype=weight_dtype)
+                vae.to(accelerator.device, dtype=weight_dtype)
+                build_latent_cache(
+                    latent_cache_dir,
+                    dataset["train"],
+                    image_column,
+                    caption_column,
+                    tokenizer,
+                    vae,
+                    text_encoder,
+                    args.resolution,
+                    center_crop=args.center_crop,
+                    random_flip=args.random_flip,
+                    batch_size=args.train_batch_size,
+                    storage_dtype=np.float32 if weight_dtype == torch.float32 else np.float16,
+                    progress_bar=tqdm(total=len(dataset["train"]), desc="Latent cache"),
+                )
+                del text_encoder, vae
+                torch.cuda.empty_cache()
+            train_dataset = LatentCacheDataset(latent_cache_dir)
+    elif args.image_cache_dir is not None:
+        image_cache_dir = os.path.join(
+            args.image_cache_dir,
+            cache_fingerprint(
+                kind="images",
+                dataset=args.dataset_name or args.train_data_dir,
+                dataset_config=args.dataset_config_name,
+                dataset_fingerprint=dataset["train"]._fingerprint,
+                image_column=image_column,
+                resolution=args.resolution,
+                center_crop=args.center_crop,
+            ),
+        )
+        with accelerator.main_process_first():
+            if accelerator.is_main_process and read_cache_index(image_cache_dir) is None:
+                logger.info(f"Building image cache in {image_cache_dir}")
+                build_image_cache(
+                    image_cache_dir,
+                    dataset["train"],
+                    image_column,
+                    args.resolution,
+                    center_crop=args.center_crop,
+                    progress_bar=tqdm(total=len(dataset["train"]), desc="Image cache"),
+                )
+            train_dataset = ImageCacheDataset(
+                image_cache_dir,
+                random_flip=args.random_flip and not args.gpu_augmentation,
+                normalize=not args.gpu_augmentation,
+            )
+
+    caption_index = None
+    if args.latent_cache_dir is None and not args.streaming:
+        # Every caption variant is tokenized once, fetching a sample then only indexes into the token arrays.
+        caption_cache_dir = os.path.join(
+            dataset_cache_root,
+            "captions-"
+            + cache_fingerprint(
+                kind="captions",
+                dataset_fingerprint=dataset["train"]._fingerprint,
+                caption_column=caption_column,
+                tokenizer=args.pretrained_model_name_or_path,
+                revision=args.revision,
+            ),
+        )
+        with accelerator.main_process_first():
+            if accelerator.is_main_process and read_cache_index(caption_cache_dir) is None:
+                logger.info(f"Tokenizing captions into {caption_cache_dir}")
+                build_caption_cache(caption_cache_dir, dataset["train"][caption_column], caption_column, tokenizer)
+            caption_index = CaptionTokenIndex(caption_cache_dir, seed=data_seed)
+        train_dataset = CaptionIndexedDataset(train_dataset, caption_index)
 
     def collate_fn(examples):
+        if args.latent_cache_dir is not None:
+            latent_moments = torch.stack([example["latent_moments"] for example in examples])
+            encoder_hidden_states = torch.stack([example["encoder_hidden_states"] for example in examples])
+            return {"latent_moments": latent_moments, "encoder_hidden_states": encoder_hidden_states}
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
-        pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
+        if not args.gpu_augmentation:
+            pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
         input_ids = torch.stack([example["input_ids"] for example in examples])
-        return {"pixel_values": pixel_values, "input_ids": input_ids}
+        batch = {"pixel_values": pixel_values, "input_ids": input_ids}
+        if args.text_embedding_cache_mb > 0:
+            # Hash the tokens here, while they are still on the host.
+            batch["caption_keys"] = [caption_key(ids) for ids in input_ids]
+        return batch
+
+    def make_stream_batch(examples):
+        images = [decode_image(example[image_column]).convert("RGB") for example in examples]
+        # take a random caption if there are multiple
+        captions = [random.choice(caption_variants(example[caption_column], caption_column)) for example in examples]
+        input_ids = tokenizer(
+            captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+        ).input_ids
+        return collate_fn(
+            [{"pixel_values": train_transforms(image), "input_ids": ids} for image, ids in zip(images, input_ids)]
+        )
 
     # DataLoaders creation:
+    if args.streaming:
+        # Batches are assembled in the dataloader workers, and every process streams until `--max_train_steps`.
+        train_dataset = StreamingDataset(
+            train_dataset, make_stream_batch, args.train_batch_size, num_workers=args.dataloader_num_workers
+        )
+    elif train_sampler is None:
+        # The shuffle order is a function of the seed and the epoch only, so a resumed run can skip straight to the
+        # next unseen batch.
+        train_sampler = BucketBatchSampler(
+            np.zeros(len(train_dataset), dtype=np.int64), args.train_batch_size, seed=data_seed, drop_last=False
+        )
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
-        shuffle=True,
-        collate_fn=collate_fn,
-        batch_size=args.train_batch_size,
+        collate_fn=collate_fn if not args.streaming else None,
+        batch_sampler=train_sampler,
+        batch_size=None if args.streaming else 1,
+        # Creating an iterator draws a base seed from this generator, not from the global RNG whose state is saved
+        # with the checkpoints. A resumed run then sees the same noise as an uninterrupted one as long as the image
+        # transforms are deterministic (`--center_crop`, no `--random_flip`): the random ones draw from the global
+        # RNG in the main process, which has already fetched the next batch when a checkpoint is saved.
+        generator=torch.Generator().manual_seed(data_seed),
         num_workers=args.dataloader_num_workers,
+        pin_memory=torch.cuda.is_available(),
+        # Keep the workers alive across epochs instead of restarting them at every epoch boundary.
+        persistent_workers=args.dataloader_num_workers > 0,
+        prefetch_factor=args.dataloader_prefetch_factor if args.dataloader_num_workers > 0 else None,
     )
+    if args.streaming:
+        # An epoch is a pass over the data when the dataset declares its number of examples, otherwise the whole run.
+        split_info = dataset["train"].info.splits.get("train") if dataset["train"].info.splits else None
+        num_examples = split_info.num_examples if split_info is not None and split_info.num_examples else None
+        if num_examples is not None and args.max_train_samples is not None:
+            num_examples = min(num_examples, args.max_train_samples)
+        if num_examples is not None:
+            batches_per_epoch = math.ceil(num_examples / (args.train_batch_size * accelerator.num_processes))
+        else:
+            batches_per_epoch = args.max_train_steps * args.gradient_accumulation_steps
+        train_sampler = StreamingEpochs(train_dataloader, batches_per_epoch)
 
     # Scheduler and math around the number of training steps.
     # Check the PR https://github.com/huggingface/diffusers/pull/8312 for detailed explanation.
@@ -825,29 +1691,39 @@ def main():
     )
 
     # Prepare everything with our `accelerator`.
-    unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        unet, optimizer, train_dataloader, lr_scheduler
-    )
+    if args.streaming:
+        # Every process already streams its own part of the data, accelerate must not shard the batches again.
+        unet, optimizer, lr_scheduler = accelerator.prepare(unet, optimizer, lr_scheduler)
+        train_dataloader = BatchPrefetcher(train_sampler, accelerator.device, max(args.prefetch_batches, 1))
+    elif args.prefetch_batches > 0:
+        # The prefetcher does the host-to-device copies itself.
+        train_dataloader = accelerator.prepare_data_loader(train_dataloader, device_placement=False)
+        unet, optimizer, lr_scheduler = accelerator.prepare(unet, optimizer, lr_scheduler)
+        train_dataloader = BatchPrefetcher(
+            train_dataloader, accelerator.device, args.prefetch_batches, gradient_state=accelerator.gradient_state
+        )
+    else:
+        unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            unet, optimizer, train_dataloader, lr_scheduler
+        )
 
+    ema_updater = None
     if args.use_ema:
         if args.offload_ema:
-            ema_unet.pin_memory()
+            if torch.cuda.is_available():
+                ema_unet.pin_memory()
         else:
             ema_unet.to(accelerator.device)
-
-    # For mixed precision training we cast all non-trainable weights (vae, non-lora text_encoder and non-lora unet) to half-precision
-    # as these weights are only used for inference, keeping weights in full precision is not required.
-    weight_dtype = torch.float32
-    if accelerator.mixed_precision == "fp16":
-        weight_dtype = torch.float16
-        args.mixed_precision = accelerator.mixed_precision
-    elif accelerator.mixed_precision == "bf16":
-        weight_dtype = torch.bfloat16
-        args.mixed_precision = accelerator.mixed_precision
+        ema_updater = EMAUpdater(ema_unet, args.ema_update_every, asynchronous=args.offload_ema)
 
     # Move text_encode and vae to gpu and cast to weight_dtype
-    text_encoder.to(accelerator.device, dtype=weight_dtype)
-    vae.to(accelerator.device, dtype=weight_dtype)
+    if args.latent_cache_dir is None:
+        text_encoder.to(accelerator.device, dtype=weight_dtype)
+        vae.to(accelerator.device, dtype=weight_dtype)
+
+    text_embedding_cache = None
+    if args.latent_cache_dir is None and args.text_embedding_cache_mb > 0:
+        text_embedding_cache = TextEmbeddingCache(text_encoder, int(args.text_embedding_cache_mb * 2**20))
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
@@ -879,7 +1755,8 @@ def main():
     total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
 
     logger.info("***** Running training *****")
-    logger.info(f"  Num examples = {len(train_dataset)}")
+    if not args.streaming:
+        logger.info(f"  Num examples = {len(train_dataset)}")
     logger.info(f"  Num Epochs = {args.num_train_epochs}")
     logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
@@ -887,17 +1764,14 @@ def main():
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
     global_step = 0
     first_epoch = 0
+    # Number of batches (across all processes) of `first_epoch` that were already trained on.
+    resume_batches = 0
+    # With `--streaming`, where every dataloader worker of this process stands after the last batch trained on.
+    stream_positions = list(train_dataset.positions) if args.streaming else None
 
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
-        if args.resume_from_checkpoint != "latest":
-            path = os.path.basename(args.resume_from_checkpoint)
-        else:
-            # Get the most recent checkpoint
-            dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith("checkpoint")]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-            path = dirs[-1] if len(dirs) > 0 else None
+        path = resume_checkpoint_name(args)
 
         if path is None:
             accelerator.print(
@@ -912,6 +1786,30 @@ def main():
 
             initial_global_step = global_step
             first_epoch = global_step // num_update_steps_per_epoch
+            sampler_state = read_sampler_state(os.path.join(args.output_dir, path))
+            if args.streaming:
+                # The epochs of a stream are counted in steps, and the stream continues where every worker stopped.
+                resume_batches = (global_step % num_update_steps_per_epoch) * args.gradient_accumulation_steps
+                positions = (sampler_state or {}).get("stream_positions")
+                if (
+                    positions is not None
+                    and len(positions) == accelerator.num_processes
+                    and len(positions[accelerator.process_index]) == len(stream_positions)
+                ):
+                    train_dataset.load_state_dict(positions[accelerator.process_index])
+                    stream_positions = list(train_dataset.positions)
+                else:
+                    logger.warning(
+                        "The checkpoint has no stream positions for this number of processes and dataloader workers,"
+                        " the stream starts over."
+                    )
+            elif sampler_state is not None:
+                train_sampler.load_state_dict(sampler_state)
+                first_epoch = sampler_state["epoch"]
+                resume_batches = sampler_state["batches_in_epoch"]
+                if resume_batches >= len(train_sampler):
+                    first_epoch += 1
+                    resume_batches = 0
 
     else:
         initial_global_step = 0
@@ -924,108 +1822,212 @@ def main():
         disable=not accelerator.is_local_main_process,
     )
 
-    for epoch in range(first_epoch, args.num_train_epochs):
-        train_loss = 0.0
-        for step, batch in enumerate(train_dataloader):
-            with accelerator.accumulate(unet):
-                # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(weight_dtype)).latent_dist.sample()
-                latents = latents * vae.config.scaling_factor
-
-                # Sample noise that we'll add to the latents
-                noise = torch.randn_like(latents)
-                if args.noise_offset:
-                    # https://www.crosslabs.org//blog/diffusion-with-offset-noise
-                    noise += args.noise_offset * torch.randn(
-                        (latents.shape[0], latents.shape[1], 1, 1), device=latents.device
-                    )
-                if args.input_perturbation:
-                    new_noise = noise + args.input_perturbation * torch.randn_like(noise)
-                bsz = latents.shape[0]
-                # Sample a random timestep for each image
-                timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-                timesteps = timesteps.long()
-
-                # Add noise to the latents according to the noise magnitude at each timestep
-                # (this is the forward diffusion process)
-                if args.input_perturbation:
-                    noisy_latents = noise_scheduler.add_noise(latents, new_noise, timesteps)
-                else:
-                    noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
-
-                # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+    if args.latent_cache_dir is not None:
+        latent_scaling_factor = train_dataset.scaling_factor
+        vae = text_encoder = None
+    else:
+        latent_scaling_factor = vae.config.scaling_factor
+
+    preemption = PreemptionHandler(args.preemption_grace_period)
+    preemption.install()
+
+    def preemption_requested():
+        if accelerator.num_processes == 1:
+            return preemption.requested
+        # The signal may reach the processes at different steps, they all have to stop at the same one. Agreeing on
+        # that takes a collective and a host sync, so it only happens where the loop already waits for the metrics
+        # or a checkpoint.
+        if global_step % args.log_every_n_steps != 0 and global_step % args.checkpointing_steps != 0:
+            return False
+        requested = torch.tensor(float(preemption.requested), device=accelerator.device)
+        return accelerator.reduce(requested, reduction="sum").item() > 0
+
+    def sampler_state(epoch, step):
+        if args.streaming:
+            # Collective: every process calls this when a checkpoint is saved.
+            return {"seed": data_seed, "stream_positions": accelerate.utils.gather_object([stream_positions])}
+        # Batches (across all processes) of `epoch` trained on so far, including the ones skipped on resume.
+        batches_in_epoch = (step + 1) * accelerator.num_processes
+        if epoch == first_epoch:
+            batches_in_epoch += resume_batches
+        return {**train_sampler.state_dict(), "batches_in_epoch": batches_in_epoch}
+
+    metrics = MetricsAccumulator(accelerator)
+    run_status = None
+    if args.status_dir is not None and accelerator.is_main_process:
+        run_status = RunStatus(
+            args.status_dir,
+            args.output_dir,
+            total_batch_size,
+            global_step=initial_global_step,
+            max_train_steps=args.max_train_steps,
+        )
+    checkpoint_writer = AsyncCheckpointWriter(accelerator, args.output_dir, args.checkpoints_total_limit)
+    step_timer = StepTimer(
+        accelerator.device,
+        output_path=(
+            os.path.join(args.output_dir, "step_timing.jsonl")
+            if args.step_timing and accelerator.is_main_process
+            else None
+        ),
+        profile_window=parse_step_window(args.profile_steps) if args.profile_steps else None,
+        profile_path=os.path.join(
+            args.output_dir,
+            f"profile_trace_rank{accelerator.process_index}_steps_{str(args.profile_steps).replace(':', '-')}.json",
+        ),
+    )
 
-                # Get the target for loss depending on the prediction type
-                if args.prediction_type is not None:
-                    # set prediction_type of scheduler if defined
-                    noise_scheduler.register_to_config(prediction_type=args.prediction_type)
+    def log_metrics():
+        logs = metrics.flush()
+        if not logs:
+            return
+        logs["lr"] = lr_scheduler.get_last_lr()[0]
+        if args.prefetch_batches > 0:
+            logs["data_wait"] = train_dataloader.wait_time
+        if text_embedding_cache is not None:
+            logs["text_cache_hit_rate"] = text_embedding_cache.hit_rate
+            logs["text_cache_mb"] = text_embedding_cache.bytes_used / 2**20
+        progress_bar.set_postfix(**logs)
+        accelerator.log(logs, step=global_step)
+        if run_status is not None:
+            run_status.update(global_step, loss=logs["train_loss"])
+
+    validation_engine = None
+    if args.validation_prompts is not None and args.validation_worker:
+        if accelerator.is_main_process:
+            # The worker parses the same arguments as this run; it exits after rendering the last checkpoint.
+            worker_cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "validation.py")]
+            worker_cmd.append(f"--trainer_pid={os.getpid()}")
+            if args.validation_worker_device is not None:
+                worker_cmd.append(f"--device={args.validation_worker_device}")
+            validation_worker = subprocess.Popen(worker_cmd + sys.argv[1:])
+            logger.info(f"Started the validation worker with PID {validation_worker.pid}")
+    elif args.validation_prompts is not None and accelerator.is_main_process:
+        validation_engine = ValidationEngine(
+            args.pretrained_model_name_or_path,
+            accelerator.unwrap_model(unet),
+            tokenizer,
+            args.validation_prompts,
+            accelerator.device,
+            weight_dtype=weight_dtype,
+            vae=vae,
+            text_encoder=text_encoder,
+            revision=args.revision,
+            batch_size=args.validation_batch_size,
+            seed=args.seed,
+            enable_xformers_memory_efficient_attention=args.enable_xformers_memory_efficient_attention,
+        )
 
-                if noise_scheduler.config.prediction_type == "epsilon":
-                    target = noise
-                elif noise_scheduler.config.prediction_type == "v_prediction":
-                    target = noise_scheduler.get_velocity(latents, noise, timesteps)
-                else:
-                    raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
+    stop_training = False
+    time_to_first_step = None
+    for epoch in range(first_epoch, args.num_train_epochs):
+        train_dataloader.set_epoch(epoch)
+        # accelerate does not forward `set_epoch` to a custom batch sampler once it is sharded.
+        train_sampler.set_epoch(epoch)
+        if epoch == first_epoch and resume_batches > 0:
+            # The sampler skips the indices, so the skipped batches are never loaded.
+            train_sampler.skip_batches(resume_batches)
+        if caption_index is not None:
+            caption_index.set_epoch(epoch)
+        for step, batch in enumerate(train_dataloader):
+            step_timer.begin_step()
+            if args.streaming:
+                worker, stream_pass, examples_in_pass = batch.pop("stream_position")
+                stream_positions[worker] = [stream_pass, examples_in_pass]
+            loss = training_step(
+                args,
+                accelerator,
+                batch,
+                unet,
+                noise_scheduler,
+                optimizer,
+                lr_scheduler,
+                weight_dtype,
+                step_timer,
+                vae=vae,
+                text_encoder=text_encoder,
+                text_embedding_cache=text_embedding_cache,
+                latent_scaling_factor=latent_scaling_factor,
+                ema_updater=ema_updater,
+            )
+            if time_to_first_step is None:
+                time_to_first_step = time.perf_counter() - main_start
+                logger.info(f"Time to first step: {time_to_first_step:.2f}s")
+            # Accumulate the loss on the device, it is only averaged across processes when logged.
+            metrics.add(train_loss=loss)
+            step_timer.end_step(step=global_step, epoch=epoch)
 
-                if args.dream_training:
-                    noisy_latents, target = compute_dream_and_update_latents(
+            # Checks if the accelerator has performed an optimization step behind the scenes
+            if accelerator.sync_gradients:
+                progress_bar.update(1)
+                global_step += 1
+                if global_step % args.log_every_n_steps == 0:
+                    log_metrics()
+                if global_step % args.checkpointing_steps == 0:
+                    if ema_updater is not None:
+                        ema_updater.wait()
+                    # Only the copy of the states to host memory happens here, the files are written in the background.
+                    checkpoint_writer.save(
+                        global_step,
                         unet,
-                        noise_scheduler,
-                        timesteps,
-                        noise,
-                        noisy_latents,
-                        target,
-                        encoder_hidden_states,
-                        args.dream_detail_preservation,
+                        optimizer,
+                        lr_scheduler,
+                        ema_unet=ema_unet if args.use_ema else None,
+                        sampler_state=sampler_state(epoch, step),
                     )
+                    logger.info(f"Saving checkpoint-{global_step}")
+                if preemption_requested():
+                    stop_training = True
 
-                # Predict the noise residual and compute loss
-                model_pred = unet(noisy_latents, timesteps, encoder_hidden_states, return_dict=False)[0]
-
-                if args.snr_gamma is None:
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
-                else:
-                    # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
-                    # Since we predict the noise instead of x_0, the original formulation is slightly changed.
-                    # This is discussed in Section 4.2 of the same paper.
-                    snr = compute_snr(noise_scheduler, timesteps)
-                    mse_loss_weights = torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(
-                        dim=1
-                    )[0]
-                    if noise_scheduler.config.prediction_type == "epsilon":
-                        mse_loss_weights = mse_loss_weights / snr
-                    elif noise_scheduler.config.prediction_type == "v_prediction":
-                        mse_loss_weights = mse_loss_weights / (snr + 1)
-
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
-                    loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
-                    loss = loss.mean()
-
-                # Gather the losses across all processes for logging (if we use distributed training).
-                avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
-                train_loss += avg_loss.item() 
-
-                # Backpropagate
-                accelerator.backward(loss)
-                if accelerator.sync_gradients:
-                    accelerator.clip_grad_norm_(unet.parameters(), args.max_grad_norm)
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
-
-            # Checks if the accelerator has performed an optimization step behind the scenes
-
-            logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
-            progress_bar.set_postfix(**logs)
-
-            if global_step >= args.max_train_steps:
+            if global_step >= args.max_train_steps or stop_training:
                 break
+        if stop_training:
+            break
 
-
+        if validation_engine is not None and epoch % args.validation_epochs == 0:
+            if args.use_ema:
+                ema_updater.wait()
+                # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
+                ema_unet.store(unet.parameters())
+                ema_unet.copy_to(unet.parameters())
+            log_validation(validation_engine, accelerator, epoch)
+            if args.use_ema:
+                # Switch back to the original UNet parameters.
+                ema_unet.restore(unet.parameters())
+
+    log_metrics()
+    step_timer.close()
+
+    if ema_updater is not None:
+        ema_updater.wait()
+    if stop_training:
+        if global_step % args.checkpointing_steps != 0:
+            logger.info(f"Preempted, saving emergency checkpoint-{global_step}")
+            checkpoint_writer.save(
+                global_step,
+                unet,
+                optimizer,
+                lr_scheduler,
+                ema_unet=ema_unet if args.use_ema and args.preemption_checkpoint == "full" else None,
+                sampler_state=sampler_state(epoch, step),
+            )
+        checkpoint_writer.close()
+        if run_status is not None:
+            run_status.update(global_step, state="preempted")
+        accelerator.end_training()
+        sys.exit(checkpointing.PREEMPTED_EXIT_CODE)
+    checkpoint_writer.close()
+    if run_status is not None:
+        run_status.update(global_step, state="finished")
 
     accelerator.end_training()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    except RuntimeError as error:
+        if not isinstance(error, torch.cuda.OutOfMemoryError):
+            raise
+        traceback.print_exc()
+        sys.exit(OUT_OF_MEMORY_EXIT_CODE)
\ No newline at end of file
@@ -0,0 +1,410 @@
+# coding=utf-8
+# Memory planner for main.py: predicts the device memory a training config takes, and the largest batch size that
+# fits, from the model configs alone. Only the configs are downloaded and no device memory is allocated: the models
+# are built on the meta device, and the activations kept for the backward pass are counted during a forward pass
+# there.
+#
+# It takes the arguments of main.py (the ones that do not change the memory are ignored), so a training command is
+# planned by running it with `memory_planner.py` instead of `main.py`:
+#
+#   python memory_planner.py --pretrained_model_name_or_path CompVis/stable-diffusion-v1-4 --resolution 512 \
+#       --mixed_precision fp16 --use_ema --train_batch_size 8 --gpu_memory_gb 24
+#
+# With `--json` the plan is printed as JSON, which is what `running.py --plan_memory` places its jobs with.
+
+import argparse
+import json
+import math
+
+import torch
+import torch.nn.functional as F
+from torch.overrides import TorchFunctionMode
+
+
+GB = 2**30
+
+# Parameters with fewer elements keep 32-bit state in the 8-bit optimizers of bitsandbytes (`min_8bit_size`), the
+# others one byte per state and one fp32 absmax per block of this many elements.
+BNB_MIN_8BIT_SIZE = 4096
+BNB_BLOCK_SIZE = 256
+
+# CUDA context, cuBLAS/cuDNN workspaces and what the caching allocator cannot hand out again, as a constant.
+DEFAULT_OVERHEAD_GB = 1.0
+
+# The ops that autocast runs in half precision, and the ones it runs in fp32 (the ones the UNet uses).
+AUTOCAST_LOWER_PRECISION = {
+    torch.conv2d,
+    F.linear,
+    torch.matmul,
+    torch.bmm,
+    torch.baddbmm,
+    F.scaled_dot_product_attention,
+}
+AUTOCAST_FP32 = {F.group_norm, F.layer_norm, F.softmax, F.mse_loss}
+
+
+class _MemoryEfficientAttention(torch.autograd.Function):
+    # What the flash and memory-efficient kernels of `scaled_dot_product_attention` (and xformers) keep for the
+    # backward pass: the inputs, the output and the log-sum-exp of every row, but not the attention matrix that the
+    # math implementation used on the meta device keeps.
+    @staticmethod
+    def forward(ctx, query, key, value):
+        output = query.new_empty(*query.shape[:-1], value.shape[-1])
+        logsumexp = query.new_empty(query.shape[:-1], dtype=torch.float32)
+        ctx.save_for_backward(query, key, value, output, logsumexp)
+        return output
+
+
+class _MetaAutocast(TorchFunctionMode):
+    """
+    `torch.autocast` for meta tensors, which the real one does not apply to: casts the inputs of the ops in
+    `AUTOCAST_LOWER_PRECISION` to `dtype` and the ones of `AUTOCAST_FP32` to fp32. The half-precision copies of the
+    trained weights are cached for the whole forward pass, as autocast does, in `weight_copies`, and their storages
+    are added to `weight_storages`. With `dtype=None` only the attention is replaced.
+    """
+
+    def __init__(self, dtype=None, weight_storages=None):
+        super().__init__()
+        self.dtype = dtype
+        self.weight_copies = {}
+        self.weight_storages = weight_storages if weight_storages is not None else set()
+
+    def _cast(self, value, dtype):
+        if not isinstance(value, torch.Tensor) or not value.is_floating_point() or value.dtype == dtype:
+            return value
+        if value.is_leaf and value.requires_grad:
+            if id(value) not in self.weight_copies:
+                self.weight_copies[id(value)] = value.to(dtype)
+                self.weight_storages.add(storage_key(self.weight_copies[id(value)]))
+            return self.weight_copies[id(value)]
+        return value.to(dtype)
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if self.dtype is not None and func in AUTOCAST_LOWER_PRECISION:
+            args = [self._cast(arg, self.dtype) for arg in args]
+        elif self.dtype is not None and func in AUTOCAST_FP32:
+            args = [self._cast(arg, torch.float32) for arg in args]
+        if func is F.scaled_dot_product_attention:
+            return _MemoryEfficientAttention.apply(*args[:3])
+        return func(*args, **kwargs)
+
+
+class SavedTensorCounter:
+    """
+    Counts the bytes of the tensors saved for the backward pass while it is entered, every storage once. Storages
+    in the set `exclude` (the weights) are not counted, it can still grow while the counter is entered.
+    """
+
+    def __init__(self, exclude):
+        self.storages = {}
+        self.exclude = exclude
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+    def pack(self, tensor):
+        key = storage_key(tensor)
+        if key not in self.exclude:
+            self.storages[key] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    def __enter__(self):
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._hooks.__exit__(*exc)
+
+
+def storage_key(tensor):
+    return tensor.untyped_storage()._cdata
+
+
+def tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def optimizer_state_bytes(parameters, use_8bit_adam=False):
+    """
+    returns the bytes of the two moment estimates of AdamW for `parameters`, or of `bnb.optim.AdamW8bit`
+    """
+    if not use_8bit_adam:
+        return sum(8 * p.numel() for p in parameters)
+    total = 0
+    for p in parameters:
+        if p.numel() < BNB_MIN_8BIT_SIZE:
+            total += 8 * p.numel()
+        else:
+            total += 2 * p.numel() + 2 * 4 * math.ceil(p.numel() / BNB_BLOCK_SIZE)
+    return total
+
+
+def trace_unet_activations(unet, latent_size, batch_size, text_config, dtype=None, gradient_checkpointing=False):
+    """
+    returns the bytes of the activations that the training step of `unet` (built on the meta device) keeps for the
+    backward pass at `batch_size` and `latent_size`, and the bytes of the weight copies made by autocast to `dtype`
+    (None without mixed precision). With gradient checkpointing that is what the checkpointed modules keep (their
+    inputs) plus the activations of the largest one, which are recomputed during the backward pass.
+    """
+    exclude = {storage_key(p) for p in unet.parameters()}
+    recomputed = []
+
+    def checkpoint(module, *args):
+        # Counts what one checkpointed module would keep, but keeps its inputs only (outside of this call).
+        for arg in args:
+            if isinstance(arg, torch.Tensor):
+                counter.pack(arg)
+        with SavedTensorCounter(exclude) as inner:
+            output = module(*args)
+        recomputed.append(inner.nbytes)
+        return output
+
+    if gradient_checkpointing:
+        unet.enable_gradient_checkpointing(checkpoint)
+    else:
+        unet.disable_gradient_checkpointing()
+
+    input_dtype = dtype or torch.float32
+    latents = torch.empty(
+        batch_size, unet.config.in_channels, latent_size, latent_size, device="meta", dtype=input_dtype
+    )
+    encoder_hidden_states = torch.empty(
+        batch_size, text_config.max_position_embeddings, text_config.hidden_size, device="meta", dtype=input_dtype
+    )
+    timesteps = torch.zeros(batch_size, device="meta", dtype=torch.long)
+
+    # The weight copies of autocast live as long as the forward pass and are counted on their own.
+    autocast = _MetaAutocast(dtype, weight_storages=exclude)
+    with autocast, SavedTensorCounter(exclude) as counter:
+        model_pred = unet(latents, timesteps, encoder_hidden_states, return_dict=False)[0]
+        F.mse_loss(model_pred.float(), latents.float(), reduction="mean")
+    return counter.nbytes + max(recomputed, default=0), tensor_bytes(autocast.weight_copies.values())
+
+
+def trace_peak_inference(model, *inputs):
+    """
+    returns an estimate of the bytes that a forward pass of `model` (built on the meta device) without gradients
+    takes at its peak: the largest inputs and outputs of any of its modules held at the same time
+    """
+    peak = 0
+
+    def hook(module, args, output):
+        nonlocal peak
+        outputs = output if isinstance(output, (tuple, list)) else [output]
+        tensors = [t for t in list(args) + list(outputs) if isinstance(t, torch.Tensor)]
+        peak = max(peak, tensor_bytes(tensors))
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()]
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return peak
+
+
+def load_models(pretrained_model_name_or_path, revision=None, non_ema_revision=None, cache_dir=None):
+    """
+    returns the UNet, VAE and text encoder of a Stable Diffusion checkpoint, built from their configs on the meta
+    device
+    """
+    from accelerate import init_empty_weights
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    def load_config(cls, subfolder, revision):
+        return cls.load_config(
+            pretrained_model_name_or_path, subfolder=subfolder, revision=revision, cache_dir=cache_dir
+        )
+
+    text_config = CLIPTextConfig.from_pretrained(
+        pretrained_model_name_or_path, subfolder="text_encoder", revision=revision, cache_dir=cache_dir
+    )
+    with init_empty_weights():
+        unet = UNet2DConditionModel.from_config(load_config(UNet2DConditionModel, "unet", non_ema_revision))
+        vae = AutoencoderKL.from_config(load_config(AutoencoderKL, "vae", revision))
+        text_encoder = CLIPTextModel(text_config)
+    return unet, vae, text_encoder
+
+
+def plan_memory(args):
+    """
+    returns the memory plan of the training config `args` (the arguments of main.py): the bytes of every component
+    that does not depend on the batch size, the activation bytes per sample with and without gradient checkpointing,
+    and the resulting totals in GB
+    """
+    unet, vae, text_encoder = load_models(
+        args.pretrained_model_name_or_path, args.revision, args.non_ema_revision, args.cache_dir
+    )
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.mixed_precision)
+    weight_dtype = dtype or torch.float32
+    weight_size = torch.tensor([], dtype=weight_dtype).element_size()
+    unet_parameters = list(unet.parameters())
+    num_unet_parameters = count_parameters(unet)
+
+    components = {
+        "unet_weights": 4 * num_unet_parameters,
+        "unet_gradients": 4 * num_unet_parameters,
+        "optimizer_state": optimizer_state_bytes(unet_parameters, args.use_8bit_adam),
+        "ema_weights": 4 * num_unet_parameters if args.use_ema and not args.offload_ema else 0,
+        "text_encoder_weights": 0,
+        "vae_weights": 0,
+    }
+    inference_per_sample = 0
+    if args.latent_cache_dir is None:
+        components["text_encoder_weights"] = weight_size * count_parameters(text_encoder)
+        components["vae_weights"] = weight_size * count_parameters(vae)
+        # The VAE encodes the batch before the UNet runs, its activations are gone by then. It is traced in fp32.
+        pixel_values = torch.empty(1, vae.config.in_channels, args.resolution, args.resolution, device="meta")
+        inference_per_sample = trace_peak_inference(vae.encoder, pixel_values) * weight_size // 4
+
+    # (bytes independent of the batch size, bytes per sample), from the activations at batch sizes 1 and 2.
+    latent_size = args.resolution // 2 ** (len(vae.config.block_out_channels) - 1)
+    activations = {}
+    for gradient_checkpointing in (False, True):
+        (one, weight_copy_bytes), (two, _) = (
+            trace_unet_activations(
+                unet, latent_size, batch_size, text_encoder.config, dtype, gradient_checkpointing
+            )
+            for batch_size in (1, 2)
+        )
+        activations[gradient_checkpointing] = (one - (two - one), two - one)
+    components["autocast_weight_copies"] = weight_copy_bytes
+    fixed_activations, per_sample = activations[args.gradient_checkpointing]
+    components["activations_fixed"] = max(fixed_activations, 0)
+    components["overhead"] = args.overhead_gb * GB
+
+    fixed_gb = sum(components.values()) / GB
+    per_sample_gb = max(per_sample, inference_per_sample) / GB
+    plan = {
+        "pretrained_model_name_or_path": args.pretrained_model_name_or_path,
+        "resolution": args.resolution,
+        "mixed_precision": args.mixed_precision,
+        "gradient_checkpointing": args.gradient_checkpointing,
+        "use_8bit_adam": args.use_8bit_adam,
+        "ema": ("offload" if args.offload_ema else "device") if args.use_ema else None,
+        "num_unet_parameters": num_unet_parameters,
+        "components_gb": {name: value / GB for name, value in components.items()},
+        "activations_per_sample_gb": {
+            "no_gradient_checkpointing": max(activations[False][1], inference_per_sample) / GB,
+            "gradient_checkpointing": max(activations[True][1], inference_per_sample) / GB,
+        },
+        "fixed_gb": fixed_gb,
+        "per_sample_gb": per_sample_gb,
+        "train_batch_size": args.train_batch_size,
+        "footprint_gb": footprint_gb(fixed_gb, per_sample_gb, args.train_batch_size),
+        "gpu_memory_gb": args.gpu_memory_gb,
+        "max_batch_size": None,
+    }
+    if args.gpu_memory_gb is not None:
+        plan["max_batch_size"] = max_batch_size(fixed_gb, per_sample_gb, args.gpu_memory_gb)
+    return plan
+
+
+def footprint_gb(fixed_gb, per_sample_gb, batch_size):
+    return fixed_gb + per_sample_gb * batch_size
+
+
+def max_batch_size(fixed_gb, per_sample_gb, memory_gb):
+    """
+    returns the largest batch size whose footprint fits in `memory_gb`, 0 if not even the batch-independent part does
+    """
+    return max(math.floor((memory_gb - fixed_gb) / per_sample_gb), 0)
+
+
+def format_plan(plan):
+    components = plan["components_gb"]
+    ema = {"device": "on the device", "offload": "offloaded", None: "none"}[plan["ema"]]
+    lines = [
+        f"Memory plan for {plan['pretrained_model_name_or_path']} at {plan['resolution']}px"
+        f" (mixed precision: {plan['mixed_precision'] or 'no'}, optimizer:"
+        f" {'AdamW8bit' if plan['use_8bit_adam'] else 'AdamW'}, EMA: {ema},"
+        f" gradient checkpointing: {'yes' if plan['gradient_checkpointing'] else 'no'})",
+        f"  {'UNet weights (fp32, ' + format(plan['num_unet_parameters'] / 1e6, '.1f') + 'M parameters)':<56}"
+        f"{components['unet_weights']:8.2f} GB",
+    ]
+    labels = {
+        "unet_gradients": "UNet gradients",
+        "optimizer_state": "optimizer state",
+        "ema_weights": "EMA weights",
+        "text_encoder_weights": "text encoder weights",
+        "vae_weights": "VAE weights",
+        "autocast_weight_copies": "autocast weight copies",
+        "activations_fixed": "activations independent of the batch size",
+        "overhead": "CUDA context and allocator overhead",
+    }
+    lines += [f"  {label:<56}{components[name]:8.2f} GB" for name, label in labels.items()]
+    lines.append(f"  {'total independent of the batch size':<56}{plan['fixed_gb']:8.2f} GB")
+    for key, label in (("no_gradient_checkpointing", "without"), ("gradient_checkpointing", "with")):
+        label = f"activations per sample, {label} gradient checkpointing"
+        lines.append(f"  {label:<56}{plan['activations_per_sample_gb'][key]:8.2f} GB")
+    lines.append(
+        f"Predicted footprint at batch size {plan['train_batch_size']}: {plan['footprint_gb']:.2f} GB"
+    )
+    if plan["gpu_memory_gb"] is not None:
+        for key, label in (("no_gradient_checkpointing", "without"), ("gradient_checkpointing", "with")):
+            batch_size = max_batch_size(
+                plan["fixed_gb"], plan["activations_per_sample_gb"][key], plan["gpu_memory_gb"]
+            )
+            lines.append(
+                f"Largest batch size in {plan['gpu_memory_gb']:.1f} GB {label} gradient checkpointing: {batch_size}"
+            )
+    return "\n".join(lines)
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(
+        description="Predicts the device memory of a main.py training config. Takes the arguments of main.py."
+    )
+    parser.add_argument("--pretrained_model_name_or_path", type=str, required=True)
+    parser.add_argument("--revision", type=str, default=None)
+    parser.add_argument("--non_ema_revision", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--train_batch_size", type=int, default=16)
+    parser.add_argument("--mixed_precision", type=str, default=None, choices=["no", "fp16", "bf16"])
+    parser.add_argument("--gradient_checkpointing", action="store_true")
+    parser.add_argument("--use_8bit_adam", action="store_true")
+    parser.add_argument("--use_ema", action="store_true")
+    parser.add_argument("--offload_ema", action="store_true")
+    parser.add_argument("--latent_cache_dir", type=str, default=None)
+    parser.add_argument(
+        "--gpu_memory_gb",
+        type=float,
+        default=None,
+        help="Device memory to fit the batch size in. Defaults to the memory of the first CUDA device, if any.",
+    )
+    parser.add_argument(
+        "--overhead_gb",
+        type=float,
+        default=DEFAULT_OVERHEAD_GB,
+        help="Memory taken besides the tensors: CUDA context, workspaces and allocator fragmentation.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the plan as JSON.")
+    # The other arguments of main.py do not change the memory.
+    args, _ = parser.parse_known_args(input_args)
+    if args.mixed_precision == "no":
+        args.mixed_precision = None
+    if args.non_ema_revision is None:
+        args.non_ema_revision = args.revision
+    if args.gpu_memory_gb is None and torch.cuda.is_available():
+        args.gpu_memory_gb = torch.cuda.get_device_properties(0).total_memory / GB
+    return args
+
+
+def main():
+    args = parse_args()
+    plan = plan_memory(args)
+    print(json.dumps(plan, indent=2) if args.json else format_plan(plan))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# coding=utf-8
+# Startup helpers for main.py: loading the pipeline components with as much overlap as is safe.
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from huggingface_hub import try_to_load_from_cache
+
+
+# The (non-sharded, non-variant) weight file of every model subfolder of a Stable Diffusion checkpoint.
+WEIGHT_FILES = {
+    "unet": "diffusion_pytorch_model.safetensors",
+    "vae": "diffusion_pytorch_model.safetensors",
+    "text_encoder": "model.safetensors",
+}
+
+
+def resolve_weight_file(pretrained_model_name_or_path, subfolder, revision=None):
+    """
+    returns the local path of the weight file of `subfolder`, or None if it is not on disk yet (it is then
+    downloaded by `from_pretrained`)
+    """
+    filename = WEIGHT_FILES[subfolder]
+    if os.path.isdir(pretrained_model_name_or_path):
+        path = os.path.join(pretrained_model_name_or_path, subfolder, filename)
+        return path if os.path.exists(path) else None
+    path = try_to_load_from_cache(pretrained_model_name_or_path, f"{subfolder}/{filename}", revision=revision)
+    return path if isinstance(path, str) else None
+
+
+def read_into_page_cache(path, chunk_bytes=16 * 2**20):
+    # Memory-mapped loading then reads from memory instead of faulting the file in page by page. Processes that
+    # load the same file share the page cache, so it is only read from disk once per machine.
+    buffer = bytearray(chunk_bytes)
+    total = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                return total
+            total += n
+
+
+class ComponentLoader:
+    """
+    Loads the pipeline components of a training run and records how long each one took.
+
+    Calling `from_pretrained` for several models at once is not safe: accelerate's `init_empty_weights` (used by
+    diffusers) and transformers patch torch globally while a model is being built, and concurrent patches can leak
+    meta-device initialization into other threads. So only work that builds no torch module runs on the thread pool
+    (`prefetch` of the weight files, `submit` of the tokenizer and scheduler), while `load` builds the models one
+    after the other on the calling thread, from pages that are already in memory.
+    """
+
+    def __init__(self, num_threads=8):
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="loader")
+        self.times = {}
+        self.start = time.perf_counter()
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.times[name] = time.perf_counter() - start
+        return result
+
+    def prefetch(self, paths):
+        futures = []
+        for path in paths:
+            if path is not None:
+                name = f"read {os.path.basename(os.path.dirname(path))}"
+                futures.append(self.executor.submit(self._timed, name, read_into_page_cache, path))
+        return futures
+
+    def submit(self, name, fn, *args, **kwargs):
+        return self.executor.submit(self._timed, name, fn, *args, **kwargs)
+
+    def load(self, name, fn, *args, **kwargs):
+        return self._timed(name, fn, *args, **kwargs)
+
+    def summary(self):
+        self.executor.shutdown(wait=True)
+        parts = [f"{name} {seconds:.2f}s" for name, seconds in self.times.items()]
+        return f"{time.perf_counter() - self.start:.2f}s ({', '.join(parts)})"
@@ -0,0 +1,131 @@
+# coding=utf-8
+# Per-phase timing of the training step and torch.profiler windows.
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+from lazy_imports import lazy_import
+
+
+# Imported on first use, so that main.py can validate `--profile_steps` with `parse_step_window` before torch is
+# loaded.
+torch = lazy_import("torch")
+
+
+_NO_TIMING = nullcontext()
+
+
+def parse_step_window(value):
+    """
+    parses a `start:end` window of training steps, `end` excluded
+    """
+    start, _, end = value.partition(":")
+    start, end = int(start), int(end)
+    if not 0 <= start < end:
+        raise ValueError(f"Invalid step window `{value}`, expected `start:end` with 0 <= start < end.")
+    return start, end
+
+
+class StepTimer:
+    """
+    Times the phases of every training step, with CUDA events on GPU and `time.perf_counter` on CPU, and appends one
+    JSON record per step to `output_path`. CUDA timings are read back only once their events have completed, so the
+    timer never makes the host wait for the device. The data wait is the host time between the end of a step and the
+    start of the next one.
+
+    If `profile_window` is set, the steps in that window are also recorded with `torch.profiler` and exported as a
+    chrome trace to `profile_path`. With neither set, `phase` returns a shared no-op context manager.
+    """
+
+    def __init__(self, device, output_path=None, profile_window=None, profile_path=None):
+        self.use_cuda = torch.device(device).type == "cuda"
+        self.timing = output_path is not None
+        self.enabled = self.timing or profile_window is not None
+        self.profile_window = profile_window
+        self.profile_path = profile_path
+        self._file = open(output_path, "a") if self.timing else None
+        self._profiler = None
+        self._step_index = 0
+        self._last_step_end = None
+        self._step_start = None
+        self._phases = []
+        self._pending = []
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NO_TIMING
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        with torch.profiler.record_function(name) if self._profiler is not None else _NO_TIMING:
+            if not self.timing:
+                yield
+            elif self.use_cuda:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self._phases.append((name, start, end))
+            else:
+                start = time.perf_counter()
+                yield
+                self._phases.append((name, start, time.perf_counter()))
+
+    def begin_step(self):
+        if not self.enabled:
+            return
+        if self.profile_window is not None and self._step_index == self.profile_window[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities)
+            self._profiler.start()
+        self._step_start = time.perf_counter()
+
+    def end_step(self, **fields):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.timing:
+            record = dict(fields)
+            record["data_wait"] = self._step_start - self._last_step_end if self._last_step_end is not None else 0.0
+            record["step_time"] = now - self._step_start
+            self._pending.append((record, self._phases))
+            self._write_completed(block=False)
+        self._phases = []
+        self._last_step_end = now
+
+        if self._profiler is not None and self._step_index == self.profile_window[1] - 1:
+            self._stop_profiler()
+        self._step_index += 1
+
+    def _stop_profiler(self):
+        self._profiler.stop()
+        self._profiler.export_chrome_trace(self.profile_path)
+        self._profiler = None
+
+    def _write_completed(self, block):
+        while self._pending:
+            record, phases = self._pending[0]
+            if self.use_cuda and phases:
+                last_event = phases[-1][2]
+                if not block and not last_event.query():
+                    return
+                last_event.synchronize()
+                for name, start, end in phases:
+                    record[name] = record.get(name, 0.0) + start.elapsed_time(end) / 1000
+            else:
+                for name, start, end in phases:
+                    record[name] = record.get(name, 0.0) + end - start
+            self._file.write(json.dumps(record) + "\n")
+            self._pending.pop(0)
+
+    def close(self):
+        if self._profiler is not None:
+            self._stop_profiler()
+        if self._file is not None:
+            self._write_completed(block=True)
+            self._file.close()
+            self._file = None
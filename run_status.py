@@ -0,0 +1,96 @@
+# coding=utf-8
+# Live status of the training runs of a host: with `--status_dir`, main.py keeps a small JSON file per run up to date
+# (PID, step, throughput, loss, ...), and `python running.py status` shows all of them in one table.
+
+import json
+import os
+import socket
+import time
+
+
+DEFAULT_STATUS_DIR = os.path.join(os.path.expanduser("~"), ".cache", "quick_sd", "runs")
+
+
+class RunStatus:
+    """
+    Keeps `<directory>/<host>-<pid>.json` up to date with the progress of this process. `update` is meant to be called
+    where the loss is already on the host (when the metrics are logged): it writes a few hundred bytes and never waits
+    for the device. The throughput is measured between two updates.
+    """
+
+    def __init__(self, directory, output_dir, samples_per_step, global_step=0, max_train_steps=None):
+        os.makedirs(directory, exist_ok=True)
+        host = socket.gethostname()
+        self.path = os.path.join(directory, f"{host}-{os.getpid()}.json")
+        self.samples_per_step = samples_per_step
+        self._last_step, self._last_time = global_step, time.time()
+        self.status = {
+            "pid": os.getpid(),
+            "host": host,
+            "gpus": os.environ.get("CUDA_VISIBLE_DEVICES"),
+            "output_dir": os.path.abspath(output_dir),
+            "state": "running",
+            "started_at": self._last_time,
+            "global_step": global_step,
+            "max_train_steps": max_train_steps,
+            "samples_per_sec": None,
+            "loss": None,
+        }
+        self._write()
+
+    def update(self, global_step, loss=None, state=None):
+        now = time.time()
+        if global_step > self._last_step:
+            elapsed = now - self._last_time
+            self.status["samples_per_sec"] = (global_step - self._last_step) * self.samples_per_step / elapsed
+            self._last_step, self._last_time = global_step, now
+        self.status["global_step"] = global_step
+        if loss is not None:
+            self.status["loss"] = loss
+        if state is not None:
+            self.status["state"] = state
+        self._write()
+
+    def _write(self):
+        self.status["updated_at"] = time.time()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.status, f)
+        # Readers never see a half-written file.
+        os.replace(tmp_path, self.path)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Runs of other users.
+        return True
+    return True
+
+
+def read_run_statuses(directory, host=None):
+    """
+    returns the statuses of the runs of `host` (this one by default) in `directory`, oldest first. A run whose process
+    is gone while its state is still "running" has crashed or was killed, its state is then "died".
+    """
+    host = host or socket.gethostname()
+    if not os.path.isdir(directory):
+        return []
+    statuses = []
+    for name in os.listdir(directory):
+        if not name.startswith(f"{host}-") or not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if status["state"] == "running" and not is_alive(status["pid"]):
+            status["state"] = "died"
+        status["path"] = path
+        statuses.append(status)
+    return sorted(statuses, key=lambda status: status["started_at"])
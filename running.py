@@ -1,10 +1,28 @@
 import argparse
+import json
+import signal
 import subprocess
 import os
+import sys
+import time
 
-def run_command(gpu_rank, batch_size=4):
-    cmd = [
-        "python", "main.py",
+from run_status import DEFAULT_STATUS_DIR, read_run_statuses
+
+# Exit code of main.py after an emergency checkpoint on SIGTERM/SIGUSR1 (checkpointing.PREEMPTED_EXIT_CODE).
+PREEMPTED_EXIT_CODE = 75
+# Exit code of main.py when it runs out of device memory (main.OUT_OF_MEMORY_EXIT_CODE).
+OUT_OF_MEMORY_EXIT_CODE = 86
+
+# Device memory (GB) main.py takes at 512px by batch size, as measured for train.sh. Other batch sizes are
+# interpolated; a job can also give its own `memory_gb`, or be planned by memory_planner.py with --plan_memory.
+MEASURED_FOOTPRINT_GB = [(1, 18), (4, 20), (32, 70)]
+# A job that ran out of memory is requeued with this much more memory than it was given.
+OOM_GROWTH = 1.25
+# Logs of earlier launches of a run (restarts after a preemption, ...) that are kept next to the current one.
+LOG_BACKUPS = 5
+
+def main_args(batch_size=4, output_dir="output", resume=False, extra_args=()):
+    args = [
         "--pretrained_model_name_or_path=CompVis/stable-diffusion-v1-4",
         "--dataset_name=lambdalabs/naruto-blip-captions",
         "--resolution=512",
@@ -15,37 +33,325 @@ def run_command(gpu_rank, batch_size=4):
         "--max_grad_norm=1",
         "--lr_scheduler=constant",
         "--lr_warmup_steps=0",
-        "--output_dir=output"
+        f"--output_dir={output_dir}"
     ]
-    
+    args += list(extra_args)
+    if resume:
+        args.append("--resume_from_checkpoint=latest")
+    return args
+
+def open_log(output_dir):
+    # Every launch writes <output_dir>/logs/main.log, the logs of the launches before it become main.log.1 (the
+    # latest) to main.log.<LOG_BACKUPS>.
+    log_dir = os.path.join(output_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    path = os.path.join(log_dir, 'main.log')
+    for i in range(LOG_BACKUPS - 1, 0, -1):
+        if os.path.exists(f'{path}.{i}'):
+            os.replace(f'{path}.{i}', f'{path}.{i + 1}')
+    if os.path.exists(path):
+        os.replace(path, f'{path}.1')
+    return open(path, 'w')
+
+def run_command(gpu_rank, batch_size=4, output_dir="output", resume=False, extra_args=()):
+    cmd = ["python", "main.py"] + main_args(batch_size, output_dir, resume, extra_args)
+
     env = os.environ.copy()
+    # Number the GPUs like nvidia-smi does, which the memory probe reads.
+    env['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
     env['CUDA_VISIBLE_DEVICES'] = str(gpu_rank)
-    
-    with open(os.devnull, 'w') as DEVNULL:
+    # The progress bar goes to the log file too; the status file has the live numbers.
+    env['TQDM_MININTERVAL'] = '60'
+
+    with open_log(output_dir) as log:
         process = subprocess.Popen(
             cmd,
             env=env,
-            stdout=DEVNULL,
-            stderr=DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
             preexec_fn=os.setpgrp
         )
-    return process.pid
+    return process
+
+def supervise(runs, max_restarts):
+    # runs: gpu_rank -> (process, run_command kwargs)
+    restarts = {gpu_rank: 0 for gpu_rank in runs}
+    stopping = False
+
+    def forward(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process, _ in runs.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGUSR1, forward)
+
+    while runs:
+        time.sleep(1)
+        for gpu_rank, (process, kwargs) in list(runs.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            del runs[gpu_rank]
+            if code == PREEMPTED_EXIT_CODE and not stopping and restarts[gpu_rank] < max_restarts:
+                restarts[gpu_rank] += 1
+                kwargs = dict(kwargs, resume=True)
+                process = run_command(gpu_rank, **kwargs)
+                runs[gpu_rank] = (process, kwargs)
+                print(f"Process on GPU {gpu_rank} was preempted, resumed from the latest checkpoint with PID"
+                      f" {process.pid} (restart {restarts[gpu_rank]}/{max_restarts})")
+            else:
+                print(f"Process on GPU {gpu_rank} exited with code {code}")
+
+def estimate_footprint_gb(batch_size):
+    points = MEASURED_FOOTPRINT_GB
+    for (b0, m0), (b1, m1) in zip(points, points[1:]):
+        if batch_size <= b1 or b1 == points[-1][0]:
+            return m0 + (m1 - m0) * (batch_size - b0) / (b1 - b0)
+
+# memory_planner.py plans, by the extra main.py arguments of the jobs they were made for.
+_PLANS = {}
+
+def plan_footprint_gb(batch_size, extra_args=()):
+    # Most jobs only differ by their batch size, so every other set of arguments is planned once and the plan gives
+    # the footprint at any batch size.
+    key = tuple(extra_args)
+    if key not in _PLANS:
+        cmd = ['python', 'memory_planner.py'] + main_args(extra_args=extra_args) + ['--json']
+        _PLANS[key] = json.loads(subprocess.run(cmd, capture_output=True, text=True, check=True).stdout)
+    plan = _PLANS[key]
+    return plan['fixed_gb'] + plan['per_sample_gb'] * batch_size
+
+class NvidiaSmiProbe:
+    # gpu -> (free GB, total GB)
+    def __call__(self):
+        output = subprocess.run(
+            ['nvidia-smi', '--query-gpu=index,memory.free,memory.total', '--format=csv,noheader,nounits'],
+            capture_output=True, text=True, check=True
+        ).stdout
+        memory = {}
+        for line in output.strip().splitlines():
+            index, free, total = (int(x) for x in line.split(','))
+            memory[index] = (free / 1024, total / 1024)
+        return memory
+
+class FakeProbe:
+    # Fixed free memory, e.g. GPUs that nothing but the scheduled jobs runs on; tests can change `free_gb`.
+    def __init__(self, total_gb, free_gb=None):
+        self.total_gb = dict(total_gb)
+        self.free_gb = dict(free_gb or total_gb)
+
+    def __call__(self):
+        return {gpu: (self.free_gb[gpu], self.total_gb[gpu]) for gpu in self.total_gb}
+
+def make_job(name, batch_size, output_dir, memory_gb=None, extra_args=(), plan_memory=False):
+    kwargs = dict(batch_size=batch_size, output_dir=os.path.join(output_dir, name), resume=False,
+                  extra_args=list(extra_args))
+    if not memory_gb:
+        memory_gb = plan_footprint_gb(batch_size, extra_args) if plan_memory else estimate_footprint_gb(batch_size)
+    return {'name': name, 'memory_gb': memory_gb, 'kwargs': kwargs, 'restarts': 0, 'oom_retries': 0}
+
+def read_jobs(path, output_dir, extra_args=(), plan_memory=False):
+    # A JSON list of {"name", "batch_size", optional "memory_gb", optional "args": [main.py arguments]}.
+    with open(path) as f:
+        specs = json.load(f)
+    return [make_job(spec['name'], spec['batch_size'], output_dir, spec.get('memory_gb'),
+                     list(extra_args) + spec.get('args', []), plan_memory) for spec in specs]
+
+def available_memory_gb(memory, running, margin_gb):
+    # A job that is still starting up does not show in the free memory yet, and one that has started does: counting
+    # the estimates of our jobs against the total and taking the smaller of both covers either case.
+    available = {}
+    for gpu, (free_gb, total_gb) in memory.items():
+        reserved_gb = sum(job['memory_gb'] for job_gpu, _, job in running if job_gpu == gpu)
+        available[gpu] = min(free_gb, total_gb - reserved_gb) - margin_gb
+    return available
+
+def pick_gpu(job, available):
+    fits = [gpu for gpu, gb in available.items() if gb >= job['memory_gb']]
+    # Best fit, which keeps the GPUs with the most room for the larger jobs.
+    return min(fits, key=lambda gpu: available[gpu]) if fits else None
+
+def schedule(jobs, gpus, probe, margin_gb=2, max_restarts=10, max_oom_retries=3, poll_interval=10):
+    queue = list(jobs)
+    running = []  # (gpu, process, job)
+    largest_gb = max(total_gb for gpu, (_, total_gb) in probe().items() if gpu in gpus) - margin_gb
+    for job in queue:
+        if job['memory_gb'] > largest_gb:
+            print(f"Job {job['name']} needs an estimated {job['memory_gb']:.1f}GB, it will run alone on a GPU")
+            job['memory_gb'] = largest_gb
+    stopping = False
+
+    def forward(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for _, process, _ in running:
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGUSR1, forward)
+
+    while running or (queue and not stopping):
+        for entry in list(running):
+            gpu, process, job = entry
+            code = process.poll()
+            if code is None:
+                continue
+            running.remove(entry)
+            if code == PREEMPTED_EXIT_CODE and not stopping and job['restarts'] < max_restarts:
+                job = dict(job, restarts=job['restarts'] + 1, kwargs=dict(job['kwargs'], resume=True))
+                queue.insert(0, job)
+                print(f"Job {job['name']} was preempted on GPU {gpu}, requeued to resume from its latest checkpoint"
+                      f" (restart {job['restarts']}/{max_restarts})")
+            elif code == OUT_OF_MEMORY_EXIT_CODE and not stopping and job['oom_retries'] < max_oom_retries:
+                memory_gb = min(job['memory_gb'] * OOM_GROWTH, largest_gb)
+                job = dict(job, oom_retries=job['oom_retries'] + 1, memory_gb=memory_gb,
+                           kwargs=dict(job['kwargs'], resume=True))
+                queue.insert(0, job)
+                print(f"Job {job['name']} ran out of memory on GPU {gpu}, requeued with {memory_gb:.1f}GB"
+                      f" (retry {job['oom_retries']}/{max_oom_retries})")
+            else:
+                print(f"Job {job['name']} on GPU {gpu} exited with code {code}")
+
+        if queue and not stopping:
+            memory = {gpu: m for gpu, m in probe().items() if gpu in gpus}
+            available = available_memory_gb(memory, running, margin_gb)
+            # Jobs further down the queue start when the ones before them do not fit anywhere yet.
+            for job in list(queue):
+                gpu = pick_gpu(job, available)
+                if gpu is None:
+                    continue
+                queue.remove(job)
+                process = run_command(gpu, **job['kwargs'])
+                running.append((gpu, process, job))
+                available[gpu] -= job['memory_gb']
+                print(f"Started job {job['name']} ({job['memory_gb']:.1f}GB) on GPU {gpu} with PID {process.pid}")
+        time.sleep(poll_interval)
+
+def format_age(seconds):
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 7200:
+        return f'{seconds / 60:.0f}m'
+    return f'{seconds / 3600:.1f}h'
+
+def status(argv):
+    parser = argparse.ArgumentParser(prog='running.py status',
+                                     description='Show the main.py runs of this host that keep a status file.')
+    parser.add_argument('--status_dir', type=str, default=DEFAULT_STATUS_DIR)
+    parser.add_argument('--prune', action='store_true', help='Remove the status files of runs that are over.')
+    args = parser.parse_args(argv)
+
+    statuses = read_run_statuses(args.status_dir)
+    now = time.time()
+    rows = [('PID', 'GPU', 'STATE', 'STEP', 'SAMPLES/S', 'LOSS', 'UPDATED', 'LOG')]
+    for run in statuses:
+        step = str(run['global_step'])
+        if run['max_train_steps'] is not None and run['max_train_steps'] < 10 ** 9:
+            step += f"/{run['max_train_steps']}"
+        rows.append((str(run['pid']), run['gpus'] or '-', run['state'], step,
+                     '-' if run['samples_per_sec'] is None else f"{run['samples_per_sec']:.2f}",
+                     '-' if run['loss'] is None else f"{run['loss']:.4f}",
+                     format_age(now - run['updated_at']) + ' ago',
+                     os.path.join(run['output_dir'], 'logs', 'main.log')))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+    if args.prune:
+        for run in statuses:
+            if run['state'] != 'running':
+                os.remove(run['path'])
 
 def main():
+    if sys.argv[1:2] == ['status']:
+        status(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--processes', nargs='+', type=int, required=True)
     parser.add_argument('-b', '--batch_sizes', nargs='+', type=int)
+    parser.add_argument('-o', '--output_dir', type=str, default='output',
+                        help='With several processes, every one of them writes to <output_dir>/gpu<rank>.')
+    parser.add_argument('--resume', action='store_true', help='Resume every run from its latest checkpoint.')
+    parser.add_argument('--supervise', action='store_true',
+                        help='Stay in the foreground and relaunch runs that exit after an emergency checkpoint '
+                             '(SIGTERM/SIGUSR1) from their latest checkpoint.')
+    parser.add_argument('--max_restarts', type=int, default=10, help='Relaunches per run with --supervise.')
+    parser.add_argument('--validation_prompts', nargs='+', type=str)
+    parser.add_argument('--validation_worker', action='store_true',
+                        help='Render the validation prompts of every new checkpoint in a sidecar process '
+                             '(validation.py) instead of inside the training loop.')
+    parser.add_argument('--validation_worker_device', type=str, default=None)
+    parser.add_argument('--schedule', action='store_true',
+                        help='Treat -b (and --jobs) as a queue of jobs and pack them onto the GPUs of -p by their '
+                             'estimated memory, starting queued jobs as others finish and requeueing jobs that run '
+                             'out of memory. Every job writes to <output_dir>/<name>.')
+    parser.add_argument('--jobs', type=str, default=None,
+                        help='JSON file with a list of jobs: {"name", "batch_size", "memory_gb" (optional), '
+                             '"args" (optional main.py arguments)}. Implies --schedule.')
+    parser.add_argument('--plan_memory', action='store_true',
+                        help='Estimate the memory of jobs without "memory_gb" with memory_planner.py from their '
+                             'main.py arguments, instead of from the footprints measured for train.sh.')
+    parser.add_argument('--memory_margin_gb', type=float, default=2,
+                        help='Device memory left free on every GPU with --schedule.')
+    parser.add_argument('--max_oom_retries', type=int, default=3)
+    parser.add_argument('--poll_interval', type=float, default=10)
+    parser.add_argument('--status_dir', type=str, default=DEFAULT_STATUS_DIR,
+                        help='Where the runs keep their status files, which `running.py status` reads. Their output '
+                             'goes to <output_dir>/logs/main.log.')
+    parser.add_argument('--fake_gpu_memory', nargs='+', type=float,
+                        help='Total memory (GB) of every GPU of -p, instead of asking nvidia-smi (for testing).')
 
     args = parser.parse_args()
-    
-    if args.batch_sizes and len(args.batch_sizes) != len(args.processes):
+
+    if args.batch_sizes and len(args.batch_sizes) != len(args.processes) and not (args.schedule or args.jobs):
         print("Error: Number of batch sizes must match number of processes")
         return
 
+    extra_args = [f'--status_dir={args.status_dir}']
+    if args.validation_prompts:
+        extra_args += ['--validation_prompts'] + args.validation_prompts
+    if args.validation_worker:
+        extra_args.append('--validation_worker')
+    if args.validation_worker_device:
+        extra_args.append(f'--validation_worker_device={args.validation_worker_device}')
+
+    if args.schedule or args.jobs:
+        jobs = [make_job(f'bs{batch_size}-{i}', batch_size, args.output_dir, extra_args=extra_args,
+                         plan_memory=args.plan_memory)
+                for i, batch_size in enumerate(args.batch_sizes or [])]
+        if args.jobs:
+            jobs += read_jobs(args.jobs, args.output_dir, extra_args, args.plan_memory)
+        if args.resume:
+            for job in jobs:
+                job['kwargs']['resume'] = True
+        if args.fake_gpu_memory:
+            if len(args.fake_gpu_memory) != len(args.processes):
+                print("Error: Number of fake GPU memory sizes must match number of processes")
+                return
+            probe = FakeProbe(dict(zip(args.processes, args.fake_gpu_memory)))
+        else:
+            probe = NvidiaSmiProbe()
+        schedule(jobs, args.processes, probe, args.memory_margin_gb, args.max_restarts, args.max_oom_retries,
+                 args.poll_interval)
+        return
+
+    runs = {}
     for i, gpu_rank in enumerate(args.processes):
         batch_size = args.batch_sizes[i] if args.batch_sizes else 4
-        pid = run_command(gpu_rank, batch_size)
-        print(f"Started process on GPU {gpu_rank} with PID {pid}")
+        # Concurrent runs must not share their checkpoints, `--resume_from_checkpoint latest` would mix them up.
+        output_dir = args.output_dir if len(args.processes) == 1 else os.path.join(args.output_dir, f"gpu{gpu_rank}")
+        kwargs = dict(batch_size=batch_size, output_dir=output_dir, resume=args.resume, extra_args=extra_args)
+        process = run_command(gpu_rank, **kwargs)
+        runs[gpu_rank] = (process, kwargs)
+        print(f"Started process on GPU {gpu_rank} with PID {process.pid}")
+
+    if args.supervise:
+        supervise(runs, args.max_restarts)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
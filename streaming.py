@@ -0,0 +1,106 @@
+# coding=utf-8
+# Streaming input pipeline for main.py (`--streaming`): the training samples are read from a `datasets.IterableDataset`
+# while training runs, so training starts without a pass over the data and memory does not grow with the dataset.
+
+import itertools
+
+import torch
+from datasets import Image
+from datasets.distributed import split_dataset_by_node
+
+
+def prepare_stream(dataset, image_column, process_index, num_processes, seed=0, shuffle_buffer_size=1000):
+    """
+    returns the part of the streamed split `dataset` that process `process_index` trains on. Whole shards (files) are
+    assigned to the processes when their number allows it, and `datasets` splits them again between the dataloader
+    workers of a process. The images stay encoded through the shuffle buffer, which holds `shuffle_buffer_size`
+    examples, and are only decoded by `decode_image` once a batch is assembled.
+    """
+    dataset = dataset.cast_column(image_column, Image(decode=False))
+    dataset = split_dataset_by_node(dataset, rank=process_index, world_size=num_processes)
+    return dataset.shuffle(seed=seed, buffer_size=shuffle_buffer_size)
+
+
+def decode_image(value):
+    """
+    decodes an image of a column cast to `Image(decode=False)`
+    """
+    return Image().decode_example(value)
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    """
+    Endless stream of training batches over a split prepared by `prepare_stream`. The passes over the data follow each
+    other, every one reshuffled with `set_epoch(pass)`, so every process yields batches for as long as training runs
+    and all of them stop at the same step. Every dataloader worker reads its own shards and turns whole batches of
+    examples into a training batch with `make_batch` (decoding included); use it with `batch_size=None`.
+
+    Every batch carries `stream_position = (worker, pass, examples)`: where that worker stands in the stream once the
+    batch is consumed. The positions of the last batch consumed from every worker are what `load_state_dict` takes
+    to resume the stream; the examples before them are read again but not decoded. A resumed dataloader starts with
+    its first worker again, so with several workers the same batches can come in a rotated order.
+    """
+
+    def __init__(self, dataset, make_batch, batch_size, num_workers=0):
+        self.dataset = dataset
+        self.make_batch = make_batch
+        self.batch_size = batch_size
+        self.positions = [None] * max(num_workers, 1)
+
+    def load_state_dict(self, positions):
+        if len(positions) != len(self.positions):
+            raise ValueError(f"Got the stream positions of {len(positions)} workers instead of {len(self.positions)}.")
+        self.positions = list(positions)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker = worker_info.id if worker_info is not None else 0
+        stream_pass, skip = self.positions[worker] or (0, 0)
+        examples = []
+        while True:
+            self.dataset.set_epoch(stream_pass)
+            num_examples = skip
+            for example in itertools.islice(self.dataset, skip, None):
+                examples.append(example)
+                num_examples += 1
+                if len(examples) == self.batch_size:
+                    batch = self.make_batch(examples)
+                    batch["stream_position"] = (worker, stream_pass, num_examples)
+                    yield batch
+                    examples = []
+            if num_examples == 0:
+                # No shard was assigned to this worker.
+                return
+            stream_pass, skip = stream_pass + 1, 0
+
+
+class StreamingEpochs:
+    """
+    Cuts an endless dataloader into epochs of `num_batches` batches: every iteration continues the stream where the
+    previous one stopped. It stands in for the batch sampler of a map-style dataset in the epoch loop of main.py.
+    """
+
+    def __init__(self, dataloader, num_batches):
+        self.dataloader = dataloader
+        self.num_batches = num_batches
+        self._iterator = None
+        self._skip = 0
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        # The stream reshuffles itself at every pass over the data, which is not tied to these epochs.
+        pass
+
+    def skip_batches(self, num_batches):
+        """
+        shortens the next epoch by `num_batches` batches, for a run resumed in the middle of an epoch
+        """
+        self._skip = num_batches
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.dataloader)
+        num_batches, self._skip = self.num_batches - self._skip, 0
+        return itertools.islice(self._iterator, max(num_batches, 0))
@@ -0,0 +1,225 @@
+# coding=utf-8
+# Training data packed into tar shards (WebDataset layout), read sequentially instead of as millions of small files.
+#
+# Every sample is a group of consecutive members named `<key>.<column>.<extension>`: the encoded image as it was in
+# the source dataset (`000000042.image.jpg`) and the caption as JSON (`000000042.text.json`), so the column names,
+# and `--image_column` / `--caption_column`, are the same as in the source. The directory also holds an `index.json`
+# with the shard names, the number of samples and the features, and is used by pointing `--train_data_dir` at it.
+#
+# Converting an imagefolder or a Hub dataset:
+#
+#   python tar_shards.py --train_data_dir <imagefolder> --output_dir <shards>
+#   python tar_shards.py --dataset_name lambdalabs/naruto-blip-captions --output_dir <shards>
+
+import argparse
+import io
+import json
+import os
+import tarfile
+
+import datasets
+from PIL import Image
+
+from data_cache import begin_cache_build, cache_fingerprint, finish_cache_build, read_cache_index
+
+
+# A shard is read front to back with reads of this size, which is what network filesystems are fast at.
+READ_BUFFER_BYTES = 16 * 2**20
+
+
+def is_tar_shard_dir(directory):
+    index = read_cache_index(directory)
+    return index is not None and index.get("kind") == "tar_shards"
+
+
+def read_tar_shards(paths, index_fingerprint=None, read_buffer_bytes=READ_BUFFER_BYTES):
+    """
+    yields the samples of the tar shards `paths`, one shard after the other. Images are returned encoded, as the
+    `{"bytes", "path"}` dicts of `datasets.Image`, and JSON members are parsed. `index_fingerprint` is only part of
+    the cache key of `Dataset.from_generator`.
+    """
+    for path in paths:
+        with open(path, "rb", buffering=read_buffer_bytes) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+            example, example_key = {}, None
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, column, extension = member.name.split(".")
+                if key != example_key:
+                    if example:
+                        yield example
+                    example, example_key = {}, key
+                data = tar.extractfile(member).read()
+                example[column] = json.loads(data) if extension == "json" else {"bytes": data, "path": member.name}
+            if example:
+                yield example
+
+
+def load_tar_shards(directory, streaming=False, cache_dir=None, process_index=0, num_processes=1):
+    """
+    returns a `{"train": dataset}` dict over the tar shards in `directory`, like `load_dataset` does.
+
+    Without streaming the shards are read once into the Arrow cache. With streaming, process `process_index` only
+    gets every `num_processes`-th shard, and `datasets` splits those between its dataloader workers the same way.
+    """
+    index = read_cache_index(directory)
+    if index is None or index.get("kind") != "tar_shards":
+        raise ValueError(f"No tar shards found in {directory}.")
+    features = datasets.Features.from_dict(index["features"])
+    paths = [os.path.join(directory, name) for name in index["shards"]]
+
+    if not streaming:
+        fingerprint = cache_fingerprint(kind="tar_shards", directory=os.path.abspath(directory), index=index)
+        dataset = datasets.Dataset.from_generator(
+            read_tar_shards,
+            features=features,
+            cache_dir=cache_dir,
+            gen_kwargs={"paths": paths, "index_fingerprint": fingerprint},
+            fingerprint=fingerprint,
+        )
+        return datasets.DatasetDict({"train": dataset})
+
+    if len(paths) < num_processes:
+        raise ValueError(
+            f"{directory} has {len(paths)} shards, streaming it needs at least one per process ({num_processes})."
+        )
+    dataset = datasets.IterableDataset.from_generator(
+        read_tar_shards, features=features, gen_kwargs={"paths": paths[process_index::num_processes]}
+    )
+    # Lets the training loop count epochs.
+    dataset.info.splits = datasets.SplitDict()
+    dataset.info.splits.add(datasets.SplitInfo(name="train", num_examples=index["num_examples"]))
+    return datasets.IterableDatasetDict({"train": dataset})
+
+
+def _image_file(value):
+    # `value` is an image of a column cast to `Image(decode=False)`.
+    data = value["bytes"]
+    if data is None:
+        with open(value["path"], "rb") as f:
+            data = f.read()
+    extension = os.path.splitext(value["path"] or "")[1].lstrip(".").lower()
+    if not extension:
+        extension = Image.open(io.BytesIO(data)).format.lower()
+    return data, extension
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_tar_shards(
+    output_dir, dataset, image_column, caption_column, samples_per_shard=1000, progress_bar=None, overwrite=False
+):
+    """
+    writes the samples of `dataset` (a `Dataset` or `IterableDataset`) into tar shards of `samples_per_shard`
+    samples in `output_dir`. The images are copied without re-encoding.
+
+    `output_dir` is replaced once the shards are complete. If it already exists, it has to hold tar shards or be
+    empty, unless `overwrite` is set.
+    """
+    if os.path.isdir(output_dir) and os.listdir(output_dir) and not is_tar_shard_dir(output_dir) and not overwrite:
+        raise ValueError(
+            f"{output_dir} is not empty and does not hold tar shards, its contents would be deleted. Pass"
+            " `--overwrite` to replace it anyway."
+        )
+    for column in (image_column, caption_column):
+        if "." in column:
+            raise ValueError(f"Column names cannot contain dots, got `{column}`.")
+    caption_feature = None
+    if dataset.features is not None:
+        caption_feature = dataset.features[caption_column]
+    features = datasets.Features(
+        {image_column: datasets.Image(), caption_column: caption_feature or datasets.Value("string")}
+    )
+    dataset = dataset.cast_column(image_column, datasets.Image(decode=False))
+
+    tmp_dir = begin_cache_build(output_dir)
+    shards = []
+    tar = None
+    num_examples = 0
+    for example in dataset:
+        if num_examples % samples_per_shard == 0:
+            if tar is not None:
+                tar.close()
+            shards.append(f"shard-{len(shards):06d}.tar")
+            tar = tarfile.open(os.path.join(tmp_dir, shards[-1]), "w")
+        data, extension = _image_file(example[image_column])
+        _add_member(tar, f"{num_examples:09d}.{image_column}.{extension}", data)
+        caption = json.dumps(example[caption_column]).encode("utf-8")
+        _add_member(tar, f"{num_examples:09d}.{caption_column}.json", caption)
+        num_examples += 1
+        if progress_bar is not None:
+            progress_bar.update(1)
+    if tar is not None:
+        tar.close()
+
+    index = {
+        "kind": "tar_shards",
+        "num_examples": num_examples,
+        "shards": shards,
+        "features": features.to_dict(),
+    }
+    finish_cache_build(tmp_dir, output_dir, index)
+    return index
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Converts an imagefolder or a Hub dataset into tar shards.")
+    parser.add_argument("--dataset_name", type=str, default=None, help="Dataset on the Hub to convert.")
+    parser.add_argument("--dataset_config_name", type=str, default=None)
+    parser.add_argument("--train_data_dir", type=str, default=None, help="Imagefolder to convert.")
+    parser.add_argument("--image_column", type=str, default="image")
+    parser.add_argument("--caption_column", type=str, default="text")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where to write the shards.")
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Replace `--output_dir` even if it holds something else than tar shards. Its contents are deleted.",
+    )
+    parser.add_argument("--cache_dir", type=str, default=None)
+    args = parser.parse_args(input_args)
+    if args.dataset_name is None and args.train_data_dir is None:
+        raise ValueError("Need either a dataset name or a training folder.")
+    return args
+
+
+def main():
+    from tqdm.auto import tqdm
+
+    args = parse_args()
+    # The source is streamed, so it is read once and never converted to Arrow.
+    if args.dataset_name is not None:
+        dataset = datasets.load_dataset(
+            args.dataset_name,
+            args.dataset_config_name,
+            cache_dir=args.cache_dir,
+            data_dir=args.train_data_dir,
+            split="train",
+            streaming=True,
+        )
+    else:
+        dataset = datasets.load_dataset(
+            "imagefolder",
+            data_files={"train": os.path.join(args.train_data_dir, "**")},
+            cache_dir=args.cache_dir,
+            split="train",
+            streaming=True,
+        )
+    index = write_tar_shards(
+        args.output_dir,
+        dataset,
+        args.image_column,
+        args.caption_column,
+        samples_per_shard=args.samples_per_shard,
+        progress_bar=tqdm(desc="Samples"),
+        overwrite=args.overwrite,
+    )
+    print(f"Wrote {index['num_examples']} samples into {len(index['shards'])} shards in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+from accelerate import Accelerator
+from accelerate.state import AcceleratorState, GradientState
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from data_utils import BatchPrefetcher  # noqa: E402
+
+
+@pytest.fixture
+def accelerator():
+    accelerator = Accelerator(gradient_accumulation_steps=4, cpu=True)
+    yield accelerator
+    AcceleratorState._reset_state(reset_partial_state=True)
+    GradientState._reset_state()
+
+
+def sync_steps(accelerator, prefetch_batches, num_epochs=2, num_batches=6):
+    """
+    returns the (1-based) micro-steps at which `accelerator.accumulate` synced over `num_epochs` epochs
+    """
+    model = torch.nn.Linear(2, 1)
+    dataloader = torch.utils.data.DataLoader(torch.randn(num_batches, 2), batch_size=1)
+    if prefetch_batches > 0:
+        dataloader = accelerator.prepare_data_loader(dataloader, device_placement=False)
+        dataloader = BatchPrefetcher(
+            dataloader, accelerator.device, prefetch_batches, gradient_state=accelerator.gradient_state
+        )
+    else:
+        dataloader = accelerator.prepare(dataloader)
+    model = accelerator.prepare(model)
+
+    steps = []
+    micro_step = 0
+    for _ in range(num_epochs):
+        for batch in dataloader:
+            micro_step += 1
+            with accelerator.accumulate(model):
+                model(batch).sum().backward()
+                if accelerator.sync_gradients:
+                    steps.append(micro_step)
+    return steps
+
+
+@pytest.mark.parametrize("prefetch_batches", [1, 2, 4, 8])
+def test_prefetcher_keeps_accumulation_windows(accelerator, prefetch_batches):
+    # Every epoch of 6 batches ends with a step of its last 2 batches, as without prefetching.
+    assert sync_steps(accelerator, 0) == [4, 6, 10, 12]
+    assert sync_steps(accelerator, prefetch_batches) == [4, 6, 10, 12]
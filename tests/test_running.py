@@ -0,0 +1,100 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import running  # noqa: E402
+
+
+class FakeProcess:
+    """exits with `code` at its `polls`-th poll, i.e. after that many rounds of the scheduler"""
+
+    def __init__(self, name, events, polls, code):
+        self.name, self.events, self.polls, self.code = name, events, polls, code
+        self.pid = 0
+
+    def poll(self):
+        self.polls -= 1
+        if self.polls > 0:
+            return None
+        if self.polls == 0:
+            self.events.append(("exit", self.name))
+        return self.code
+
+
+class FakeLauncher:
+    """
+    stands in for `running.run_command`. `plan[name]` lists the (polls, exit code) of the successive launches of a
+    job, and `events` records what happened, in order: ("start", name, gpu, resume) and ("exit", name).
+    """
+
+    def __init__(self, plan):
+        self.plan = {name: list(launches) for name, launches in plan.items()}
+        self.events = []
+
+    def __call__(self, gpu_rank, batch_size=4, output_dir="output", resume=False, extra_args=()):
+        name = os.path.basename(output_dir)
+        self.events.append(("start", name, gpu_rank, resume))
+        polls, code = self.plan[name].pop(0)
+        return FakeProcess(name, self.events, polls, code)
+
+
+@pytest.fixture
+def launch(monkeypatch):
+    def install(plan):
+        launcher = FakeLauncher(plan)
+        monkeypatch.setattr(running, "run_command", launcher)
+        return launcher.events
+
+    # `schedule` forwards SIGTERM/SIGUSR1 to its jobs, the handlers of the test process are left alone.
+    monkeypatch.setattr(running.signal, "signal", lambda signum, handler: None)
+    return install
+
+
+def make_job(name, memory_gb):
+    return running.make_job(name, 4, "runs", memory_gb=memory_gb)
+
+
+def test_packs_jobs_by_memory(launch):
+    events = launch({"a": [(3, 0)], "b": [(3, 0)], "c": [(2, 0)], "d": [(2, 0)]})
+    jobs = [make_job("a", 20), make_job("b", 20), make_job("c", 40), make_job("d", 60)]
+    running.schedule(jobs, [0, 1], running.FakeProbe({0: 48, 1: 80}), poll_interval=0)
+
+    # Best fit: the small jobs share the small GPU, which leaves the large one room for "c". "d" only fits once "c"
+    # is done.
+    assert events == [
+        ("start", "a", 0, False),
+        ("start", "b", 0, False),
+        ("start", "c", 1, False),
+        ("exit", "c"),
+        ("start", "d", 1, False),
+        ("exit", "a"),
+        ("exit", "b"),
+        ("exit", "d"),
+    ]
+
+
+def test_requeues_out_of_memory_jobs_with_more_memory(launch):
+    events = launch({"big": [(1, running.OUT_OF_MEMORY_EXIT_CODE), (1, 0)], "small": [(3, 0)]})
+    jobs = [make_job("big", 30), make_job("small", 45)]
+    running.schedule(jobs, [0], running.FakeProbe({0: 80}), poll_interval=0)
+
+    # Requeued with 30 * OOM_GROWTH = 37.5GB, "big" no longer fits next to "small" and resumes once it is done.
+    assert events == [
+        ("start", "big", 0, False),
+        ("start", "small", 0, False),
+        ("exit", "big"),
+        ("exit", "small"),
+        ("start", "big", 0, True),
+        ("exit", "big"),
+    ]
+
+
+def test_gives_up_after_max_oom_retries(launch):
+    events = launch({"big": [(1, running.OUT_OF_MEMORY_EXIT_CODE)] * 2})
+    running.schedule([make_job("big", 30)], [0], running.FakeProbe({0: 80}), max_oom_retries=1, poll_interval=0)
+    starts = [event for event in events if event[0] == "start"]
+    assert starts == [("start", "big", 0, False), ("start", "big", 0, True)]
@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+import datasets
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tar_shards import is_tar_shard_dir, load_tar_shards, write_tar_shards  # noqa: E402
+
+
+def make_dataset(num_examples=5):
+    return datasets.Dataset.from_dict(
+        {
+            "image": [Image.new("RGB", (8, 8), (i, 0, 0)) for i in range(num_examples)],
+            "text": [f"caption {i}" for i in range(num_examples)],
+        },
+        features=datasets.Features({"image": datasets.Image(), "text": datasets.Value("string")}),
+    )
+
+
+def test_write_and_read_back(tmp_path):
+    index = write_tar_shards(str(tmp_path / "shards"), make_dataset(), "image", "text", samples_per_shard=2)
+    assert index["num_examples"] == 5 and len(index["shards"]) == 3
+    dataset = load_tar_shards(str(tmp_path / "shards"), cache_dir=str(tmp_path / "cache"))["train"]
+    assert dataset["text"] == [f"caption {i}" for i in range(5)]
+
+
+def test_refuses_to_replace_other_contents(tmp_path):
+    output_dir = tmp_path / "data"
+    output_dir.mkdir()
+    (output_dir / "notes.txt").write_text("keep")
+    with pytest.raises(ValueError, match="--overwrite"):
+        write_tar_shards(str(output_dir), make_dataset(), "image", "text")
+    assert (output_dir / "notes.txt").read_text() == "keep"
+
+    write_tar_shards(str(output_dir), make_dataset(), "image", "text", overwrite=True)
+    assert is_tar_shard_dir(str(output_dir)) and not (output_dir / "notes.txt").exists()
+
+
+def test_replaces_existing_shards(tmp_path):
+    output_dir = str(tmp_path / "shards")
+    write_tar_shards(output_dir, make_dataset(5), "image", "text")
+    index = write_tar_shards(output_dir, make_dataset(3), "image", "text")
+    assert index["num_examples"] == 3
@@ -0,0 +1,70 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+from diffusers.training_utils import EMAModel
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from train_utils import EMAUpdater  # noqa: E402
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.LayerNorm(4))
+    model[1].requires_grad_(False)
+    return model
+
+
+def train_steps(model, num_steps):
+    for step in range(num_steps):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(0.01 * (step + 1))
+        yield
+
+
+@pytest.mark.parametrize("foreach", [False, True])
+def test_matches_ema_model_step(foreach):
+    model = make_model()
+    reference = EMAModel(model.parameters(), decay=0.9, foreach=foreach)
+    ema = EMAModel(model.parameters(), decay=0.9, foreach=foreach)
+    updater = EMAUpdater(ema)
+    for _ in train_steps(model, 5):
+        reference.step(model.parameters())
+        updater.step(model.parameters())
+    assert ema.optimization_step == reference.optimization_step == 5
+    for shadow, expected in zip(ema.shadow_params, reference.shadow_params):
+        torch.testing.assert_close(shadow, expected)
+
+
+def test_foreach_is_honored(monkeypatch):
+    model = make_model()
+    calls = []
+    monkeypatch.setattr(torch, "_foreach_lerp_", lambda *args: calls.append(args))
+    EMAUpdater(EMAModel(model.parameters(), foreach=False)).step(model.parameters())
+    assert not calls
+    EMAUpdater(EMAModel(model.parameters(), foreach=True)).step(model.parameters())
+    assert calls
+
+
+def test_resume_keeps_update_phase():
+    model = make_model()
+    straight = EMAModel(model.parameters(), decay=0.9)
+    straight_updater = EMAUpdater(straight, update_every=2)
+    steps = train_steps(model, 6)
+    for _ in range(3):
+        next(steps)
+        straight_updater.step(model.parameters())
+
+    # A resumed run restores the EMA state at step 3 into a new EMAModel and updater.
+    resumed = EMAModel(model.parameters(), decay=0.9)
+    resumed.load_state_dict({**straight.state_dict(), "shadow_params": [p.clone() for p in straight.shadow_params]})
+    assert resumed.optimization_step == 3
+    resumed_updater = EMAUpdater(resumed, update_every=2)
+    for _ in steps:
+        straight_updater.step(model.parameters())
+        resumed_updater.step(model.parameters())
+    for shadow, expected in zip(resumed.shadow_params, straight.shadow_params):
+        torch.testing.assert_close(shadow, expected, rtol=0, atol=0)
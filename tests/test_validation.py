@@ -0,0 +1,133 @@
+import json
+import os
+import string
+import subprocess
+import sys
+from pathlib import Path
+
+import huggingface_hub
+import pytest
+import torch
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from main import parse_args  # noqa: E402
+from validation import parse_worker_args, run_worker  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    # `save_model_card` looks for an existing card of the run on the Hub first.
+    monkeypatch.setattr(huggingface_hub.constants, "HF_HUB_OFFLINE", True)
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tmp_path_factory):
+    """
+    a Stable Diffusion layout with randomly initialized models small enough to sample on the CPU
+    """
+    root = tmp_path_factory.mktemp("model")
+    torch.manual_seed(0)
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for c in string.ascii_lowercase + string.digits:
+        vocab[c] = len(vocab)
+        vocab[c + "</w>"] = len(vocab)
+    (root / "tokenizer").mkdir()
+    (root / "tokenizer" / "vocab.json").write_text(json.dumps(vocab))
+    (root / "tokenizer" / "merges.txt").write_text("#version: 0.2\n")
+    CLIPTokenizer(
+        str(root / "tokenizer" / "vocab.json"), str(root / "tokenizer" / "merges.txt"), model_max_length=16
+    ).save_pretrained(root / "tokenizer")
+    CLIPTextModel(
+        CLIPTextConfig(
+            vocab_size=len(vocab),
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            max_position_embeddings=16,
+            bos_token_id=0,
+            eos_token_id=1,
+            pad_token_id=1,
+        )
+    ).save_pretrained(root / "text_encoder")
+    AutoencoderKL(
+        block_out_channels=[8, 16],
+        down_block_types=["DownEncoderBlock2D"] * 2,
+        up_block_types=["UpDecoderBlock2D"] * 2,
+        latent_channels=4,
+        norm_num_groups=8,
+    ).save_pretrained(root / "vae")
+    unet = UNet2DConditionModel(
+        block_out_channels=(8, 16),
+        layers_per_block=1,
+        sample_size=16,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        norm_num_groups=8,
+        attention_head_dim=2,
+    )
+    unet.save_pretrained(root / "unet")
+    DDPMScheduler(num_train_timesteps=100).save_pretrained(root / "scheduler")
+    (root / "model_index.json").write_text(
+        json.dumps(
+            {
+                "_class_name": "StableDiffusionPipeline",
+                "feature_extractor": [None, None],
+                "safety_checker": [None, None],
+                "requires_safety_checker": False,
+                "scheduler": ["diffusers", "DDPMScheduler"],
+                "text_encoder": ["transformers", "CLIPTextModel"],
+                "tokenizer": ["transformers", "CLIPTokenizer"],
+                "unet": ["diffusers", "UNet2DConditionModel"],
+                "vae": ["diffusers", "AutoencoderKL"],
+            }
+        )
+    )
+    return root, unet
+
+
+def worker_args(model_dir, output_dir, *worker_options):
+    return parse_worker_args(
+        [
+            "--device",
+            "cpu",
+            *worker_options,
+            f"--pretrained_model_name_or_path={model_dir}",
+            f"--output_dir={output_dir}",
+            "--train_data_dir=unused",
+            "--validation_prompts",
+            "a cat",
+            "a dog",
+            "--seed=0",
+        ]
+    )
+
+
+def test_renders_newest_checkpoint(tiny_model, tmp_path):
+    model_dir, unet = tiny_model
+    for step in (2, 4):
+        unet.save_pretrained(tmp_path / f"checkpoint-{step}" / "unet")
+
+    options, main_args = worker_args(model_dir, tmp_path, "--once")
+    run_worker(options, parse_args(main_args))
+
+    # Only the newest checkpoint is rendered when the worker falls behind.
+    assert os.listdir(tmp_path / "validation") == ["checkpoint-4.png"]
+    assert (tmp_path / "README.md").exists() and (tmp_path / "val_imgs_grid.png").exists()
+
+
+def test_exits_with_the_trainer(tiny_model, tmp_path):
+    model_dir, unet = tiny_model
+    unet.save_pretrained(tmp_path / "checkpoint-2" / "unet")
+    trainer = subprocess.Popen([sys.executable, "-c", "pass"])
+    trainer.wait()
+
+    # Without `--once` the worker keeps polling until the trainer is gone, after rendering its last checkpoint.
+    options, main_args = worker_args(model_dir, tmp_path, "--trainer_pid", str(trainer.pid), "--poll_interval", "0")
+    run_worker(options, parse_args(main_args))
+    assert os.listdir(tmp_path / "validation") == ["checkpoint-2.png"]
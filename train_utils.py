@@ -0,0 +1,187 @@
+# coding=utf-8
+# Helpers for the training step in main.py.
+
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def caption_key(input_ids):
+    """
+    returns a stable 64-bit hash of one row of token ids, usable as a `TextEmbeddingCache` key
+    """
+    digest = hashlib.blake2b(input_ids.cpu().numpy().tobytes(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class TextEmbeddingCache:
+    """
+    On-device LRU cache of text encoder hidden states keyed by `caption_key`. Only the distinct captions of a batch
+    that are not cached go through `text_encoder`; least recently used entries are evicted to stay within
+    `max_bytes`.
+    """
+
+    def __init__(self, text_encoder, max_bytes):
+        self.text_encoder = text_encoder
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.hits = 0
+        self.lookups = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.lookups, 1)
+
+    def _insert(self, key, hidden_states):
+        size = hidden_states.numel() * hidden_states.element_size()
+        if size > self.max_bytes:
+            return
+        while self.bytes_used + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes_used -= evicted.numel() * evicted.element_size()
+        self.entries[key] = hidden_states
+        self.bytes_used += size
+
+    @torch.no_grad()
+    def __call__(self, input_ids, keys):
+        hidden_states = [None] * len(keys)
+        misses = OrderedDict()
+        for i, key in enumerate(keys):
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                hidden_states[i] = cached
+            else:
+                misses.setdefault(key, []).append(i)
+        self.lookups += len(keys)
+        self.hits += len(keys) - sum(len(rows) for rows in misses.values())
+
+        if misses:
+            rows = torch.tensor([rows[0] for rows in misses.values()], device=input_ids.device)
+            encoded = self.text_encoder(input_ids[rows], return_dict=False)[0]
+            for (key, indices), states in zip(misses.items(), encoded):
+                # Clone so that a cached row does not keep the whole batch alive.
+                states = states.clone()
+                self._insert(key, states)
+                for i in indices:
+                    hidden_states[i] = states
+        return torch.stack(hidden_states)
+
+
+class MetricsAccumulator:
+    """
+    Sums scalar metrics on the device without synchronizing. `flush` averages them over the added steps and across
+    processes with a single reduction, and is the only place where the host waits for the device.
+    """
+
+    def __init__(self, accelerator):
+        self.accelerator = accelerator
+        self.sums = {}
+        self.count = 0
+
+    def add(self, **metrics):
+        for name, value in metrics.items():
+            value = value.detach().float()
+            if name in self.sums:
+                self.sums[name] += value
+            else:
+                self.sums[name] = value.clone()
+        self.count += 1
+
+    def flush(self):
+        if self.count == 0:
+            return {}
+        names = sorted(self.sums)
+        values = torch.stack([self.sums[name] for name in names]) / self.count
+        values = self.accelerator.reduce(values, reduction="mean").tolist()
+        self.sums = {}
+        self.count = 0
+        return dict(zip(names, values))
+
+
+class EMAUpdater:
+    """
+    Updates the shadow parameters of `ema_model` (a diffusers `EMAModel`) from the model parameters every
+    `update_every` optimizer steps. The decay is raised to the power `update_every`, so the averaging horizon in
+    optimizer steps does not depend on the interval. `ema_model.optimization_step` counts every optimizer step, and
+    the updates run when it is a multiple of `update_every`, so a resumed run (which restores it) keeps the interval
+    where it was. Like `EMAModel.step`, the lerp uses the foreach kernels if `ema_model.foreach` is set.
+
+    With `asynchronous` (for an EMA offloaded to host memory) the parameters are copied into pinned host buffers and
+    the lerp into the shadow parameters runs on a background thread, overlapped with the next steps. `wait` has to be
+    called before the shadow parameters are read (checkpoints, validation).
+    """
+
+    def __init__(self, ema_model, update_every=1, asynchronous=False):
+        self.ema_model = ema_model
+        self.update_every = update_every
+        self.asynchronous = asynchronous
+        self._host_params = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ema") if asynchronous else None
+        self._pending = None
+
+    def _decay(self):
+        decay = self.ema_model.get_decay(self.ema_model.optimization_step) ** self.update_every
+        self.ema_model.cur_decay_value = decay
+        return decay
+
+    def _lerp(self, shadow_params, params, trainable, decay):
+        # Like `EMAModel.step`: parameters that are not trained are copied as they are.
+        pairs = list(zip(shadow_params, params, trainable))
+        averaged = [(s, p) for s, p, t in pairs if t]
+        copied = [(s, p) for s, p, t in pairs if not t]
+        if self.ema_model.foreach:
+            if averaged:
+                torch._foreach_lerp_([s for s, _ in averaged], [p for _, p in averaged], 1 - decay)
+            if copied:
+                torch._foreach_copy_([s for s, _ in copied], [p for _, p in copied])
+            return
+        for s, p in averaged:
+            s.lerp_(p, 1 - decay)
+        for s, p in copied:
+            s.copy_(p)
+
+    def _copy_to_host(self, params):
+        if self._host_params is None:
+            self._host_params = [
+                torch.empty(p.shape, dtype=p.dtype, pin_memory=torch.cuda.is_available()) for p in params
+            ]
+        torch._foreach_copy_(self._host_params, params, non_blocking=True)
+        if any(p.device.type == "cuda" for p in params):
+            copied = torch.cuda.Event()
+            copied.record()
+            return copied
+        return None
+
+    def _update_host(self, copied, trainable, decay):
+        if copied is not None:
+            copied.synchronize()
+        self._lerp(self.ema_model.shadow_params, self._host_params, trainable, decay)
+
+    @torch.no_grad()
+    def step(self, parameters):
+        """
+        to be called after every optimizer step
+        """
+        self.ema_model.optimization_step += 1
+        if self.ema_model.optimization_step % self.update_every != 0:
+            return
+        parameters = list(parameters)
+        trainable = [p.requires_grad for p in parameters]
+        params = [p.detach() for p in parameters]
+        decay = self._decay()
+        if not self.asynchronous:
+            self._lerp(self.ema_model.shadow_params, params, trainable, decay)
+            return
+        # The host buffers are reused, the previous update has to be done with them.
+        self.wait()
+        copied = self._copy_to_host(params)
+        self._pending = self._executor.submit(self._update_host, copied, trainable, decay)
+
+    def wait(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
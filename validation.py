@@ -0,0 +1,228 @@
+# coding=utf-8
+# Validation image generation for main.py.
+#
+# Besides the in-process `ValidationEngine`, this file is a sidecar worker that renders the validation prompts for
+# every new `checkpoint-N` of a run, so that the trainer never pauses for sampling. It takes the worker options
+# followed by the arguments of main.py:
+#
+#   python validation.py --device cpu --once <main.py arguments>
+#
+# and writes `<output_dir>/validation/checkpoint-N.png` plus the model card (README.md and val_imgs_grid.png) of the
+# newest checkpoint. `main.py --validation_worker` launches it.
+
+import argparse
+import os
+import time
+from contextlib import nullcontext
+from pathlib import Path
+
+import torch
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from diffusers import AutoencoderKL, StableDiffusionPipeline, UNet2DConditionModel
+from diffusers.utils import make_image_grid
+from run_status import is_alive
+
+
+class ValidationEngine:
+    """
+    Generates the validation images of a training run. The pipeline is built once around the live `unet` (and the
+    frozen `vae` / `text_encoder` when they are already loaded, otherwise they are loaded here), and the embeddings
+    of the fixed validation prompts are computed once, so a call only runs the denoising loop and the VAE decoder.
+
+    All prompts are denoised as one batch, split into chunks of at most `batch_size` prompts. On CUDA an out of memory
+    error halves the chunk size for this and every later call.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path,
+        unet,
+        tokenizer,
+        prompts,
+        device,
+        weight_dtype=torch.float32,
+        vae=None,
+        text_encoder=None,
+        revision=None,
+        num_inference_steps=20,
+        batch_size=None,
+        seed=None,
+        enable_xformers_memory_efficient_attention=False,
+    ):
+        self.prompts = list(prompts)
+        self.device = torch.device(device)
+        self.num_inference_steps = num_inference_steps
+        self.batch_size = batch_size or len(self.prompts)
+        self.seed = seed
+
+        if vae is None:
+            vae = AutoencoderKL.from_pretrained(pretrained_model_name_or_path, subfolder="vae", revision=revision)
+            vae.requires_grad_(False)
+            vae.to(self.device, dtype=weight_dtype)
+        owns_text_encoder = text_encoder is None
+        if owns_text_encoder:
+            text_encoder = CLIPTextModel.from_pretrained(
+                pretrained_model_name_or_path, subfolder="text_encoder", revision=revision
+            )
+            text_encoder.requires_grad_(False)
+            text_encoder.to(self.device, dtype=weight_dtype)
+
+        # Only the scheduler and the feature extractor configs are read from disk, the models are the live ones.
+        self.pipeline = StableDiffusionPipeline.from_pretrained(
+            pretrained_model_name_or_path,
+            vae=vae,
+            text_encoder=text_encoder,
+            tokenizer=tokenizer,
+            unet=unet,
+            safety_checker=None,
+            revision=revision,
+            torch_dtype=weight_dtype,
+        )
+        self.pipeline.set_progress_bar_config(disable=True)
+        if enable_xformers_memory_efficient_attention:
+            self.pipeline.enable_xformers_memory_efficient_attention()
+
+        with torch.no_grad():
+            self.prompt_embeds, self.negative_prompt_embeds = self.pipeline.encode_prompt(
+                self.prompts, self.device, num_images_per_prompt=1, do_classifier_free_guidance=True
+            )
+        if owns_text_encoder:
+            # The prompt embeddings never change, a text encoder loaded only to compute them is not kept.
+            self.pipeline.text_encoder = None
+            del text_encoder
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _generators(self):
+        if self.seed is None:
+            return None
+        # One generator per prompt, so the initial noise of an image does not depend on how the prompts are chunked.
+        return [torch.Generator(device=self.device).manual_seed(self.seed + i) for i in range(len(self.prompts))]
+
+    def __call__(self):
+        """
+        returns one PIL image per validation prompt
+        """
+        if torch.backends.mps.is_available():
+            autocast_ctx = nullcontext()
+        else:
+            autocast_ctx = torch.autocast(self.device.type)
+
+        generators = self._generators()
+        images = []
+        start = 0
+        while start < len(self.prompts):
+            end = min(start + self.batch_size, len(self.prompts))
+            try:
+                with autocast_ctx:
+                    images += self.pipeline(
+                        prompt_embeds=self.prompt_embeds[start:end],
+                        negative_prompt_embeds=self.negative_prompt_embeds[start:end],
+                        num_inference_steps=self.num_inference_steps,
+                        generator=generators[start:end] if generators is not None else None,
+                    ).images
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_size == 1:
+                    raise
+                self.batch_size = max(self.batch_size // 2, 1)
+                torch.cuda.empty_cache()
+                continue
+            start = end
+        return images
+
+
+def parse_worker_args(input_args=None):
+    parser = argparse.ArgumentParser(
+        description="Renders the validation prompts for every new checkpoint of a main.py run.",
+        epilog="All other arguments are those of main.py.",
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device to sample on."
+    )
+    parser.add_argument("--poll_interval", type=float, default=10, help="Seconds between scans of `--output_dir`.")
+    parser.add_argument(
+        "--trainer_pid",
+        type=int,
+        default=None,
+        help="Exit once this process has exited and its last checkpoint is rendered.",
+    )
+    parser.add_argument("--once", action="store_true", help="Render the newest checkpoint, if any, and exit.")
+    return parser.parse_known_args(input_args)
+
+
+def run_worker(worker_args, args):
+    # main.py imports this file, so it can only be imported here.
+    from checkpointing import has_safetensors, list_checkpoints, load_safetensors_into
+    from main import save_model_card
+
+    if args.validation_prompts is None:
+        raise ValueError("The validation worker needs `--validation_prompts`.")
+
+    device = torch.device(worker_args.device)
+    weight_dtype = torch.float32
+    if device.type == "cuda" and args.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif device.type == "cuda" and args.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    # The weights of every checkpoint are copied into this UNet in place.
+    unet = UNet2DConditionModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="unet", revision=args.non_ema_revision
+    )
+    unet.requires_grad_(False)
+    unet.to(device, dtype=weight_dtype)
+    tokenizer = CLIPTokenizer.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision
+    )
+    engine = ValidationEngine(
+        args.pretrained_model_name_or_path,
+        unet,
+        tokenizer,
+        args.validation_prompts,
+        device,
+        weight_dtype=weight_dtype,
+        revision=args.revision,
+        batch_size=args.validation_batch_size,
+        seed=args.seed,
+        enable_xformers_memory_efficient_attention=args.enable_xformers_memory_efficient_attention,
+    )
+
+    validation_dir = os.path.join(args.output_dir, "validation")
+    os.makedirs(validation_dir, exist_ok=True)
+    repo_id = args.hub_model_id or Path(args.output_dir).name
+    while True:
+        trainer_done = worker_args.trainer_pid is not None and not is_alive(worker_args.trainer_pid)
+        checkpoints = list_checkpoints(args.output_dir)
+        # When sampling is slower than checkpointing, only the newest checkpoint is rendered.
+        if checkpoints and not os.path.exists(os.path.join(validation_dir, f"{checkpoints[-1]}.png")):
+            name = checkpoints[-1]
+            checkpoint_dir = os.path.join(args.output_dir, name)
+            weights_dir = os.path.join(checkpoint_dir, "unet_ema")
+            if not has_safetensors(weights_dir):
+                weights_dir = os.path.join(checkpoint_dir, "unet")
+            try:
+                load_safetensors_into(unet.state_dict(), weights_dir)
+            except FileNotFoundError:
+                # Removed by `--checkpoints_total_limit` in the meantime.
+                continue
+            print(f"Rendering {len(args.validation_prompts)} validation prompts for {name}", flush=True)
+            images = engine()
+            make_image_grid(images, 1, len(images)).save(os.path.join(validation_dir, f"{name}.png"))
+            save_model_card(args, repo_id, images, repo_folder=args.output_dir)
+            continue
+
+        if worker_args.once or trainer_done:
+            return
+        time.sleep(worker_args.poll_interval)
+
+
+def main():
+    worker_args, main_args = parse_worker_args()
+    from main import parse_args
+
+    run_worker(worker_args, parse_args(main_args))
+
+
+if __name__ == "__main__":
+    main()